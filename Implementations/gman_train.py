@@ -5,6 +5,7 @@ import numpy as np
 import tensorflow as tf
 from tqdm import tqdm
 
+from lib.ablation import SensorAblation, single_sensor_masks
 from lib.gman_utils import loadData
 from lib.metrics.metrics_tf import masked_mae_loss
 from lib.metrics.metrics_np import calculate_metrics, masked_mae_np
@@ -43,6 +44,8 @@ parser.add_argument('--traffic_file', default='data/metr-la/metr-la.h5',
                     help='traffic file')
 parser.add_argument('--SE_file', default='data/metr-la/SE.txt',
                     help='spatial emebdding file')
+parser.add_argument('--masks_per_pass', type=int, default=1,
+                    help='number of disabled sensors stacked into one forward pass')
 parser.add_argument('--model_file', default='data/metr-la/pretrained/GMAN_latest',
                     help='save the model to disk')
 # parser.add_argument('--log_file', default='data/metr-la/logs/gman_log',
@@ -227,35 +230,29 @@ print('average:         %.2f\t\t%.2f\t\t%.2f%%' %
 
 print('Evaluating with simulated sensor failure...')
 
-loader = data['val_loader']
-all_preds = []
-valPred = compute_preds(sess, valX, valTE, batch_size=args.batch_size)
 dis_sensors = range(206)  # [189, 200]
 
-for idx, s in tqdm(enumerate(dis_sensors)):
-    augmentation_matrix = np.zeros(207)
-    augmentation_matrix[s] = 1
 
-    # Generate augmented datasets
-    augmented_dataloader = loader.augment(augmentation_matrix)
-    # Do inference [3392, 207, 12]
-    valX2_it = augmented_dataloader.get_iterator()
-    valX2 = np.array([*valX2_it])
-    valX2 = valX2[:, 0, ...].squeeze()
-    aug_preds = compute_preds(sess, valX2, valTE, batch_size=args.batch_size)
-    val_mae, val_rmse, val_mape = calculate_metrics(aug_preds, valY)
-    print('val              %.2f\t\t%.2f\t\t%.2f%%' %
-          (val_mae, val_rmse, val_mape * 100))
-    # relative_err = MAPE(normal) - MAPE(augmented)
-    #  mae error per sensor before - error per sensor after
-    err_rel = (valY != 0).astype(np.uint8) * (np.abs(valPred - valY) - np.abs(aug_preds - valY))
-    # Scale relative_err per 'frame' with softmax, then average over time.
-    all_preds.append(err_rel)
-    print(err_rel.shape)
+def predict(x, te):
+    feed_dict = {
+        X: x[..., 0],
+        TE: te,
+        is_training: False}
+    return ds.scaler.inverse_transform(sess.run(pred, feed_dict=feed_dict))
+
+
+def val_batches(batch_size):
+    for start_idx in range(0, valX.shape[0], batch_size):
+        end_idx = min(valX.shape[0], start_idx + batch_size)
+        # Sensors are disabled in the feature dimension of the model input
+        yield valX[start_idx: end_idx, ..., None], valY[start_idx: end_idx], valTE[start_idx: end_idx]
+
 
-pred_mx = np.stack(all_preds)
+# relative_err = MAPE(normal) - MAPE(augmented)
+#  mae error per sensor before - error per sensor after, summed per disabled sensor while the batches stream by
+ablation = SensorAblation(predict, single_sensor_masks(dis_sensors, 207), masks_per_pass=args.masks_per_pass)
 # Aggregate over time
-pred_mx = np.sum(pred_mx, axis=1) / pred_mx.shape[1]
+pred_mx = ablation.run(tqdm(val_batches(args.batch_size), total=math.ceil(valX.shape[0] / args.batch_size)))
 # Switch cols timesteps and sensors
 pred_mx = pred_mx.transpose((0, 2, 1))
 print(pred_mx.shape)
@@ -59,5 +59,5 @@ def main(args):
 if __name__ == "__main__":
     parser = supervisor.get_argument_parser()
     parser.add_argument('--plotheatmap', type=str, default='True', help='')
-    args = parser.parse_args()
+    args = supervisor.parse_args(parser)
     main(args)
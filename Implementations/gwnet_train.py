@@ -50,7 +50,7 @@ def main(args):
         # g['lr'] = lr
         t1 = time.time()
         dataloader['train_loader'].shuffle()
-        print(dataloader['train_loader'].xs.shape, sv)
+        print(dataloader['train_loader'].x_shape, sv)
         train_loss, train_rmse, train_mape = sv.run_epoch(dataloader['train_loader'], engine.train, args.print_every)
         t2 = time.time()
         mtrain_loss = np.mean(train_loss)
@@ -101,5 +101,5 @@ if __name__ == "__main__":
     parser.add_argument('--save', type=str, default='checkpoints/lstm', help='save path')
     parser.add_argument('--expid', type=int, default=1, help='experiment id')
     parser.add_argument('--print_every',type=int,default=50,help='')
-    args = parser.parse_args()
+    args = supervisor.parse_args(parser)
     main(args)
\ No newline at end of file
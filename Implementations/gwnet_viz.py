@@ -1,14 +1,18 @@
+import multiprocessing
+
 import torch
 from tqdm import tqdm
 
 from lib import utils
+from lib.ablation import SensorAblation, single_sensor_masks
+from lib.dataloaders.dataloader import Dataset
 import argparse
 
 import numpy as np
 import matplotlib.pyplot as plt
 import seaborn as sns
 
-from model.pytorch.gwnet_model import gwnet
+from model.pytorch.gwnet_model import check_gcn_options, gwnet
 from model.pytorch.lstm_model import LSTMNet
 
 parser = argparse.ArgumentParser()
@@ -20,6 +24,9 @@ parser.add_argument('--gcn_bool',action='store_true',help='whether to add graph
 parser.add_argument('--aptonly',action='store_true',help='whether only adaptive adj')
 parser.add_argument('--addaptadj',action='store_true',help='whether add adaptive adj')
 parser.add_argument('--randomadj',action='store_true',help='whether random initialize adaptive adj')
+parser.add_argument('--sparse_supports',action='store_true',help='diffuse with sparse (CSR) supports, for large graphs')
+parser.add_argument('--adaptive_topk',type=int,default=None,help='neighbours per node kept in the adaptive adj, dense if not given')
+parser.add_argument('--gcn_strategy',type=str,default='chain',choices=['chain', 'stacked'],help='stacked diffuses with one precomputed [I, A, A^2] operator')
 parser.add_argument('--seq_length',type=int,default=12,help='')
 parser.add_argument('--nhid',type=int,default=32,help='')
 parser.add_argument('--in_dim',type=int,default=2,help='inputs dimension')
@@ -30,32 +37,29 @@ parser.add_argument('--dropout',type=float,default=0.3,help='dropout rate')
 parser.add_argument('--weight_decay',type=float,default=0.0001,help='weight decay rate')
 parser.add_argument('--checkpoint',type=str,help='')
 parser.add_argument('--plotheatmap',type=str,default='True',help='')
+parser.add_argument('--masks_per_pass',type=int,default=1,help='number of disabled sensors stacked into one forward pass')
+parser.add_argument('--ablation_checkpoint',type=str,help='npz file the sensor sweep is saved to and resumed from')
+parser.add_argument('--workers',type=int,default=1,help='number of processes the disabled sensors are sharded across')
+parser.add_argument('--threads_per_worker',type=int,help='torch threads per process, defaults to the torch default')
 
 parser.add_argument('--lstm',action='store_true',help='whether to choose the lstm model instead')
 
 
-args = parser.parse_args()
+def predict(model, x, device):
+    testx = torch.Tensor(x).to(device)
+    testx = testx.transpose(1, 3)
+    with torch.no_grad():
+        # [64, 12, 1, 207]
+        preds = model(testx).transpose(1, 3)
+    return preds.squeeze().cpu().numpy()
 
 
-def compute_preds(scaler, loader, model, device):
-    outputs = []
-    y_vals = []
-    for iter, (x, y) in enumerate(loader.get_iterator()):
-        testx = torch.Tensor(x).to(device)
-        testy = torch.Tensor(y[..., 0]).to(device)
-        testx = testx.transpose(1, 3)
-        with torch.no_grad():
-            # [64, 12, 1, 207]
-            preds = model(testx).transpose(1, 3)
-        outputs.append(preds.squeeze())
-        y_vals.append(testy.transpose(1, 2))
-    yhat = torch.cat(outputs, dim=0)
-    realy = torch.cat(y_vals, dim=0)
-    return yhat.cpu().numpy(), realy.cpu().numpy()
+def labels(y):
+    # [64, 207, 12]
+    return np.ascontiguousarray(y[..., 0].transpose(0, 2, 1), dtype=np.float32)
 
-def main():
-    device = torch.device(args.device)
 
+def load_model(args, device):
     _, _, adj_mx = utils.load_adj(args.adjdata, args.adjtype)
     supports = [torch.tensor(i).to(device) for i in adj_mx]
     if args.randomadj:
@@ -77,52 +81,94 @@ def main():
         model = LSTMNet.from_args(args, device, supports=0, aptinit=0)
         model.to(device)
         if args.checkpoint:
-            model.load_checkpoint(torch.load(args.checkpoint))
+            model.load_checkpoint(torch.load(args.checkpoint, map_location=device))
     else:
         # --device cuda:0 --gcn_bool --addaptadj --checkpoint data/metr-la/pretrained/graph_wavenet_repr.pth
         print('Selected Graph Wavenet model')
-        model = gwnet(device, args.num_nodes, args.dropout, supports=supports, gcn_bool=args.gcn_bool, addaptadj=args.addaptadj, aptinit=adjinit)
+        model = gwnet(device, args.num_nodes, args.dropout, supports=supports, gcn_bool=args.gcn_bool, addaptadj=args.addaptadj, aptinit=adjinit, sparse_supports=args.sparse_supports, adaptive_topk=args.adaptive_topk, gcn_strategy=args.gcn_strategy)
         model.to(device)
-        model.load_state_dict(torch.load(args.checkpoint))
+        model.load_state_dict(torch.load(args.checkpoint, map_location=device))
 
     model.eval()
     print('model load successfully')
+    return model
+
+
+def load_loader(args):
+    ds = Dataset(args.data)
+    # Windows are gathered from the read-only memmap of the cached validation split
+    loader = ds.load_category('val', args.batch_size, lazy=True)
+    return ds, loader
+
+
+def sweep(args, model, loader, sensors, device, checkpoint_file=None, progress=True):
+    # Augmentation pattern, disable all sensors individually
+    # relative_err = MAPE(normal) - MAPE(augmented), summed per disabled sensor while the batches stream by
+    ablation = SensorAblation(lambda x: predict(model, x, device),
+                              single_sensor_masks(sensors, args.num_nodes),
+                              masks_per_pass=args.masks_per_pass, checkpoint_file=checkpoint_file)
+    batches = loader.get_iterator()
+    if progress:
+        batches = tqdm(batches, total=loader.num_batch)
+    # Aggregate over time
+    return ablation.run(batches, labels=labels)
+
+
+# State of a sweep worker process, the model and the loader are set up once per process
+_worker = {}
+
+
+def _init_worker(worker_args):
+    if worker_args.threads_per_worker:
+        torch.set_num_threads(worker_args.threads_per_worker)
+    device = torch.device(worker_args.device)
+    _worker['args'] = worker_args
+    _worker['device'] = device
+    _worker['model'] = load_model(worker_args, device)
+    _, _worker['loader'] = load_loader(worker_args)
+
+
+def _sweep_shard(shard):
+    shard_id, sensors = shard
+    worker_args = _worker['args']
+    checkpoint_file = None
+    if worker_args.ablation_checkpoint:
+        checkpoint_file = '{}.part{}.npz'.format(worker_args.ablation_checkpoint, shard_id)
+    return sweep(worker_args, _worker['model'], _worker['loader'], sensors, _worker['device'], checkpoint_file,
+                 progress=False)
+
+
+def parallel_sweep(args, sensors):
+    """
+    Shards the disabled sensors across args.workers processes and merges their rows of pred_mx.
+    """
+    shards = [(i, list(s)) for i, s in enumerate(np.array_split(list(sensors), args.workers)) if len(s)]
+    # spawn, forked processes would share the torch thread pool of the parent
+    with multiprocessing.get_context('spawn').Pool(args.workers, initializer=_init_worker, initargs=(args,)) as pool:
+        rows = list(tqdm(pool.imap(_sweep_shard, shards), total=len(shards)))
+    return np.concatenate(rows)
+
+
+def main(args):
+    if args.threads_per_worker:
+        torch.set_num_threads(args.threads_per_worker)
 
     print('Evaluating with simulated sensor failure...')
 
-    ds = utils.load_dataset(args.data, args.batch_size, args.batch_size, args.batch_size)
-    dataloader = ds.data
-    scaler = dataloader['scaler']
-    category = 'val'
-    loader = dataloader[category + '_loader']
-    preds, realy = compute_preds(scaler, loader, model, device)
-    print (preds.shape, realy.shape)
+    # Generates the cached validation windows before the workers memory-map them
+    ds, loader = load_loader(args)
     # Augment for 12 sensors on the map
     # dis_sensors = [3, 4, 5, 6, 12, 15, 16, 17, 23, 26, 29, 30, 33, 38, 48, 56, 64, 65, 80, 91, 93, 101, 124, 133, 134,
     #                136, 138, 144, 154, 155, 157, 159, 160, 161, 162, 163, 165, 166, 170, 174, 187, 188, 191, 192, 193,
     #                195, 196]
     dis_sensors = range(206) #[189, 200, 18, 35, 50, 21, 121, 189, 126]
 
-    # Augmentation pattern, disable all sensors individually
-    all_preds = []
-    for idx, s in tqdm(enumerate(dis_sensors)):
-        augmentation_matrix = np.zeros(207)
-        augmentation_matrix[s] = 1
-
-        # Generate augmented datasets
-        augmented_dataloader = loader.augment(augmentation_matrix)
-        # Do inference [3392, 207, 12]
-        aug_preds, _ = compute_preds(scaler, augmented_dataloader, model, device)
-        # relative_err = MAPE(normal) - MAPE(augmented)
-        #  mae error per sensor before - error per sensor after
-        err_rel = (realy != 0).astype(np.uint8) * (np.abs(preds - realy) - np.abs(aug_preds - realy))
-        # Scale relative_err per 'frame' with softmax, then average over time.
-        all_preds.append(err_rel)
-        print (err_rel.shape)
-
-    pred_mx = np.stack(all_preds)
-    # Aggregate over time
-    pred_mx = np.sum(pred_mx, axis=1) / pred_mx.shape[1]
+    if args.workers > 1:
+        pred_mx = parallel_sweep(args, dis_sensors)
+    else:
+        device = torch.device(args.device)
+        model = load_model(args, device)
+        pred_mx = sweep(args, model, loader, dis_sensors, device, args.ablation_checkpoint)
     print(pred_mx.shape)
     if args.lstm:
         ds.experiment_save(pred_mx, 'results/lstm_preds')
@@ -137,4 +183,9 @@ def main():
     ds.experiment_save_plot(plt, 'viz/hm.pdf')
 
 if __name__ == "__main__":
-    main()
+    args = parser.parse_args()
+    try:
+        check_gcn_options(args.gcn_strategy, args.sparse_supports, args.adaptive_topk)
+    except ValueError as e:
+        parser.error(str(e))
+    main(args)
@@ -0,0 +1,123 @@
+import itertools
+import os
+
+import numpy as np
+
+from lib.dataloaders.dataloader import DataLoader
+
+
+def single_sensor_masks(sensors, num_nodes):
+    """
+    :param sensors: sensors to disable, one at a time
+    :return: (len(sensors), num_nodes), row i disables sensors[i]
+    """
+    masks = np.zeros((len(sensors), num_nodes))
+    masks[np.arange(len(sensors)), list(sensors)] = 1
+    return masks
+
+
+def relative_error(preds, aug_preds, labels, null_val=0.):
+    """
+    mae error per sensor before - error per sensor after the augmentation
+    :param aug_preds: (..., batch_size, *label_shape), broadcast against preds and labels
+    """
+    return (labels != null_val).astype(np.uint8) * (np.abs(preds - labels) - np.abs(aug_preds - labels))
+
+
+class SensorAblation(object):
+    def __init__(self, predict_fn, masks, masks_per_pass=1, null_val=0., checkpoint_file=None, save_every=10):
+        """
+        Sensitivity of the predictions to failing sensors. For every mask the error delta
+        relative_error(preds, aug_preds, labels) is summed over all samples as the batches stream by.
+        Work units are (batch, group of masks), the masks of a group are stacked along the batch
+        dimension and share one forward pass.
+        :param predict_fn: fn(x, *context) -> predictions, (batch_size, ...) for a batch of x
+        :param masks: (num_masks, num_nodes), 1 for every disabled sensor
+        :param masks_per_pass: number of masks stacked into one forward pass
+        :param null_val: labels equal to null_val do not contribute
+        :param checkpoint_file: npz file partial sums are saved to and resumed from
+        :param save_every: number of batches between checkpoints
+        """
+        self.predict_fn = predict_fn
+        self.masks = (np.asarray(masks) == 1)
+        self.masks_per_pass = max(1, masks_per_pass)
+        self.null_val = null_val
+        self.checkpoint_file = checkpoint_file
+        self.save_every = save_every
+        self.sums = None
+        self.counts = np.zeros(len(self.masks), dtype=np.int64)
+        self.num_batches = 0
+
+    def _groups(self):
+        for start in range(0, len(self.masks), self.masks_per_pass):
+            yield slice(start, min(start + self.masks_per_pass, len(self.masks)))
+
+    def _accumulate(self, group, err_rel):
+        """
+        Sums the samples in the order np.sum(np.stack(all_err_rel), axis=1) does,
+        so the running sums are bit-identical to the sum over all samples at once.
+        :param err_rel: (group_size, batch_size, ...)
+        """
+        if self.sums is None:
+            self.sums = np.zeros((len(self.masks),) + err_rel.shape[2:], dtype=err_rel.dtype)
+        first = self.counts[group] == 0
+        if first.all():
+            self.sums[group] = np.sum(err_rel, axis=1)
+        else:
+            assert not first.any(), 'All masks of a group are accumulated together'
+            self.sums[group] = np.sum(np.concatenate([self.sums[group][:, None], err_rel], axis=1), axis=1)
+        self.counts[group] += err_rel.shape[1]
+
+    def process_batch(self, x, y, *context, labels=None):
+        """
+        :param x: model input, (batch_size, seq_len, num_nodes, input_dim)
+        :param y: labels in the layout of the predictions, fn(y) when labels is given
+        :param context: further inputs of predict_fn, repeated for every stacked mask
+        """
+        if labels is not None:
+            y = labels(y)
+        preds = self.predict_fn(x, *context)
+        batch_size = len(x)
+        for group in self._groups():
+            masks = self.masks[group]
+            packed_context = [np.concatenate([c] * len(masks)) for c in context]
+            aug_preds = self.predict_fn(DataLoader.apply_masks(x, masks), *packed_context)
+            aug_preds = aug_preds.reshape((len(masks), batch_size) + aug_preds.shape[1:])
+            self._accumulate(group, relative_error(preds, aug_preds, y, self.null_val))
+        self.num_batches += 1
+
+    def run(self, batches, labels=None):
+        """
+        :param batches: iterable of (x, y, *context), e.g. loader.get_iterator()
+        :param labels: fn(y) -> labels in the layout of the predictions
+        :return: (num_masks, ...) mean error delta per mask
+        """
+        self.load()
+        for batch in itertools.islice(batches, self.num_batches, None):
+            self.process_batch(*batch, labels=labels)
+            if self.checkpoint_file is not None and self.num_batches % self.save_every == 0:
+                self.save()
+        if self.checkpoint_file is not None and self.sums is not None:
+            self.save()
+        return self.result()
+
+    def result(self):
+        counts = self.counts.astype(self.sums.dtype).reshape((-1,) + (1,) * (self.sums.ndim - 1))
+        return self.sums / counts
+
+    def save(self):
+        tmp_file = '{}.{}.tmp.npz'.format(self.checkpoint_file, os.getpid())
+        np.savez(tmp_file, masks=self.masks, sums=self.sums, counts=self.counts, num_batches=self.num_batches)
+        os.replace(tmp_file, self.checkpoint_file)
+
+    def load(self):
+        """Resumes from the checkpoint, batches before num_batches are skipped by run."""
+        if self.checkpoint_file is None or not os.path.exists(self.checkpoint_file):
+            return
+        with np.load(self.checkpoint_file) as checkpoint:
+            if not np.array_equal(checkpoint['masks'], self.masks):
+                raise ValueError('Checkpoint {} was computed for other masks'.format(self.checkpoint_file))
+            self.sums = checkpoint['sums']
+            self.counts = checkpoint['counts']
+            self.num_batches = int(checkpoint['num_batches'])
+        print('Resuming sensor ablation after', self.num_batches, 'batches')
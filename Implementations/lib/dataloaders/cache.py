@@ -0,0 +1,91 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+
+
+class DatasetCache(object):
+    def __init__(self, dataset_file, cache_dir=None):
+        """
+        Content addressed cache of arrays generated from a HDF dataset.
+        Arrays are stored as raw .npy files and memory-mapped read-only on load.
+        :param dataset_file: HDF file the cached arrays are generated from
+        :param cache_dir: defaults to <dataset_file>.cache
+        """
+        self.dataset_file = dataset_file
+        self.cache_dir = cache_dir if cache_dir is not None else dataset_file + '.cache'
+        self._file_hash = None
+
+    def file_hash(self):
+        """sha1 of the dataset file, only recomputed when its size or mtime changes"""
+        if self._file_hash is not None:
+            return self._file_hash
+        stat = os.stat(self.dataset_file)
+        f_source = os.path.join(self.cache_dir, 'source.json')
+        try:
+            with open(f_source) as f:
+                source = json.load(f)
+            if source['size'] == stat.st_size and source['mtime_ns'] == stat.st_mtime_ns:
+                self._file_hash = source['sha1']
+                return self._file_hash
+        except (OSError, ValueError, KeyError):
+            pass
+        sha1 = hashlib.sha1()
+        with open(self.dataset_file, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 24), b''):
+                sha1.update(block)
+        self._file_hash = sha1.hexdigest()
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._write_json(f_source, {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha1': self._file_hash})
+        return self._file_hash
+
+    def key(self, **params):
+        params['sha1'] = self.file_hash()
+        return hashlib.sha1(json.dumps(params, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + '.npy')
+
+    def load(self, key):
+        """:return: read-only memmap of the cached array, None if it is not cached"""
+        try:
+            return np.load(self._path(key), mmap_mode='r')
+        except (OSError, ValueError):
+            return None
+
+    def save(self, key, array):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = self._path(key)
+        # Write to a temporary file first, so that readers never see a partial array
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            np.save(f, array)
+        os.replace(tmp_path, path)
+        return self.load(key)
+
+    def save_chunks(self, key, shape, dtype, chunks):
+        """
+        Writes an array that does not fit in memory, chunks are consecutive blocks along the first axis.
+        :return: read-only memmap of the cached array
+        """
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = self._path(key)
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        out = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=dtype, shape=tuple(int(n) for n in shape))
+        offset = 0
+        for chunk in chunks:
+            out[offset: offset + len(chunk)] = chunk
+            offset += len(chunk)
+        assert offset == shape[0], 'Expected {} rows, got {}'.format(shape[0], offset)
+        out.flush()
+        del out
+        os.replace(tmp_path, path)
+        return self.load(key)
+
+    @staticmethod
+    def _write_json(path, obj):
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(obj, f)
+        os.replace(tmp_path, path)
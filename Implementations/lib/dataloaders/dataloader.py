@@ -23,15 +23,30 @@ import numpy as np
 import pandas as pd
 import pickle
 
+from lib.dataloaders.cache import DatasetCache
+
 
 # Same permutation and augmentation for every model (run)
 np.random.seed(seed=42)
 
 
 class Dataset():
-    def __init__(self, dataset_file):
+    # Split ratios and sequence lengths, these are part of the cache key
+    train_ratio = 0.7
+    test_ratio = 0.2
+    seq_length_x = 12
+    seq_length_y = 12
+    y_start = 1
+
+    def __init__(self, dataset_file, use_cache=True, cache_dir=None):
+        """
+        :param dataset_file: HDF file with a (timestamps x sensors) DataFrame
+        :param use_cache: store the enriched splits next to the dataset and memory-map them on the next run
+        :param cache_dir: defaults to <dataset_file>.cache
+        """
         print ('Loading dataset', dataset_file)
-        self.df = pd.read_hdf(dataset_file)
+        self._df = None
+        self.cache = DatasetCache(dataset_file, cache_dir) if use_cache else None
         self.dataset_file = dataset_file
         self.basedir = os.path.dirname(dataset_file)
         self.ds_name = os.path.basename(self.basedir)
@@ -39,33 +54,118 @@ class Dataset():
         # Load the scaler or recompute+store it
         f_scaler = dataset_file + '.scaler.npz'
         try:
-            ld = np.load(f_scaler)
-            mean, std = float(ld['mean']), float(ld['std'])
-            self.scaler = StandardScaler(mean, std)
+            self.scaler = StandardScaler.load(f_scaler)
         except:
             print ('Computing scaler...')
-            x_train, y_train, _, _ = self.generate_train_val_test(category='train',
-                                                                  add_time_in_day=True,
-                                                                  add_day_in_week=False)
-            self.scaler = StandardScaler.compute_from(x_train)
-            # Ignore scale for timeofday/dayofweek variable
-            self.scaler.mean = float(self.scaler.mean[0])
-            self.scaler.std = float(self.scaler.std[0])
-            # for i in range(self.scaler.mean.shape[0] - 1):
-            #     self.scaler.mean[i+1] = 0
-            #     self.scaler.std[i+1] = 1.0
+            self.scaler = self._compute_scaler()
             np.savez(f_scaler,
                      mean = self.scaler.mean,
                      std = self.scaler.std)
         self.data['scaler'] = self.scaler
 
-    def load_category(self, category='val', batch_size=64, pad_with_last_sample=False, add_time_in_day=True, add_day_in_week=False):
+    def _compute_scaler(self):
+        # Same statistics as StandardScaler.compute_from(x_train)[0], without generating the windows.
+        # The timeofday/dayofweek variables are not scaled.
+        scaler = self.compute_scaler()
+        scaler.mean = float(scaler.mean)
+        scaler.std = float(scaler.std)
+        return scaler
+
+    def compute_scaler(self, per_sensor=False, exclude_unk=False, round_to_days=False, samples_per_hour=12,
+                       chunk_size=2 ** 16):
+        """
+        Streaming fit of the scaler on the train readings, every timestep is weighted by the
+        number of train input windows that contain it (see StandardScaler.compute_from).
+        :param per_sensor: mean/std per sensor instead of over all sensors
+        :param exclude_unk: exclude unknown (0) readings
+        :param round_to_days: only use the windows of the last complete days
+        """
+        x_offsets, y_offsets = self.get_offsets()
+        split = self.split_range('train', self.num_timesteps())
+        num_timesteps = split.stop - split.start
+        # t of the last observation of every train window, see generate_windows
+        starts = np.arange(abs(min(x_offsets)), abs(num_timesteps - abs(max(y_offsets))))
+        if round_to_days:
+            day = 24 * samples_per_hour
+            n_days = len(starts) // day
+            print(n_days, 'days, discard timeframes', (len(starts) - n_days * day))
+            starts = starts[-n_days * day:]
+        counts = window_counts(num_timesteps, starts, x_offsets)
+        return StandardScaler.compute_from_series(self.iter_readings(split, chunk_size), counts=counts,
+                                                  per_sensor=per_sensor, exclude_unk=exclude_unk)
+
+    def num_timesteps(self):
+        if self._df is not None:
+            return self._df.shape[0]
+        with pd.HDFStore(self.dataset_file, mode='r') as store:
+            return hdf_num_rows(store, store.keys()[0])
+
+    def iter_readings(self, split, chunk_size=2 ** 16):
+        """Yields consecutive (chunk_size, num_nodes) blocks of the readings in split"""
+        if self._df is not None:
+            for start in range(split.start, split.stop, chunk_size):
+                yield self._df.values[start: min(start + chunk_size, split.stop)]
+            return
+        with pd.HDFStore(self.dataset_file, mode='r') as store:
+            key = store.keys()[0]
+            for start in range(split.start, split.stop, chunk_size):
+                yield store.select(key, start=start, stop=min(start + chunk_size, split.stop)).values
+
+    @property
+    def df(self):
+        # The HDF file is only read when the cache cannot serve a request
+        if self._df is None:
+            self._df = pd.read_hdf(self.dataset_file)
+        return self._df
+
+    def _cached(self, params, fn):
+        if self.cache is None:
+            return fn()
+        key = self.cache.key(**params)
+        array = self.cache.load(key)
+        if array is None:
+            array = self.cache.save(key, fn())
+        return array
+
+    def get_timestamps(self):
+        """:return: pd.DatetimeIndex of the readings"""
+        timestamps = self._cached({'array': 'timestamps'}, lambda: self.df.index.values)
+        return pd.DatetimeIndex(np.asarray(timestamps), freq='infer')
+
+    def get_enriched(self, category='test', add_time_in_day=True, add_day_in_week=False):
+        """:return: enriched readings of the split, (num_timesteps, num_nodes, input_dim)"""
+        params = {
+            'array': 'enriched',
+            'category': category,
+            'train_ratio': self.train_ratio,
+            'test_ratio': self.test_ratio,
+            'seq_length_x': self.seq_length_x,
+            'seq_length_y': self.seq_length_y,
+            'y_start': self.y_start,
+            'add_time_in_day': add_time_in_day,
+            'add_day_in_week': add_day_in_week,
+        }
+        return self._cached(params, lambda: self.enrich(self.split(category),
+                                                        add_time_in_day=add_time_in_day,
+                                                        add_day_in_week=add_day_in_week))
+
+    def load_category(self, category='val', batch_size=64, pad_with_last_sample=False, add_time_in_day=True, add_day_in_week=False,
+                      as_view=None, lazy=False):
+        """
+        :param as_view: windows as read-only views over the enriched split, see generate_train_val_test.
+               None uses views when the cache is enabled, so a warm start only memory-maps the cached splits.
+        """
+        if lazy:
+            return self._load_category_lazy(category, batch_size, pad_with_last_sample,
+                                             add_time_in_day, add_day_in_week)
+        if as_view is None:
+            as_view = self.cache is not None
+        # Data format, only x is scaled
         x, y, _, _ = self.generate_train_val_test(category,
                                                   add_time_in_day=add_time_in_day,
-                                                  add_day_in_week=add_day_in_week)
-        # Data format
-        x[..., 0] = self.scaler.transform(x[..., 0])
-        # y = self.scaler.transform(y)
+                                                  add_day_in_week=add_day_in_week,
+                                                  as_view=as_view,
+                                                  scaler=self.scaler)
         loader = DataLoader(x, y, batch_size, pad_with_last_sample=pad_with_last_sample)
 
         # def __len__(self):
@@ -106,8 +206,21 @@ class Dataset():
         # assert len(x) == len2
         return loader
 
+    def _load_category_lazy(self, category, batch_size, pad_with_last_sample, add_time_in_day, add_day_in_week):
+        # Windows are gathered per batch, so there are no x_/y_ arrays for this category
+        data, starts, x_offsets, y_offsets = self.generate_windows(category,
+                                                                   add_time_in_day=add_time_in_day,
+                                                                   add_day_in_week=add_day_in_week)
+        loader = WindowDataLoader(data, starts, x_offsets, y_offsets, batch_size,
+                                  pad_with_last_sample=pad_with_last_sample, scaler=self.scaler)
+        self.data['x_shape'] = (len(starts), len(x_offsets)) + data.shape[1:]
+        self.data['y_shape'] = (len(starts), len(y_offsets)) + data.shape[1:]
+        self.data[category + '_loader'] = loader
+        return loader
+
     def generate_graph_seq2seq_io_data(self, df,
-            x_offsets, y_offsets, skip=1, add_time_in_day=True, add_day_in_week=False
+            x_offsets, y_offsets, skip=1, add_time_in_day=True, add_day_in_week=False,
+            as_view=False, scaler=None
     ):
         """
         Enrich samples with time/day of week, generate samples from:
@@ -116,11 +229,52 @@ class Dataset():
         :param y_offsets:
         :param add_time_in_day:
         :param add_day_in_week:
+        :param as_view: return read-only strided views over the enriched data instead of copying every window.
+        :param scaler: if given, the first feature of x is standardised (y keeps the raw values).
         :return:
         # x: (epoch_size, input_length, num_nodes, input_dim)
         # y: (epoch_size, output_length, num_nodes, output_dim)
         """
 
+        data = self.enrich(df, add_time_in_day=add_time_in_day, add_day_in_week=add_day_in_week)
+        return self._seq2seq_from_enriched(data, x_offsets, y_offsets, skip=skip, as_view=as_view, scaler=scaler)
+
+    def _seq2seq_from_enriched(self, data, x_offsets, y_offsets, skip=1, as_view=False, scaler=None):
+        num_samples = data.shape[0]
+        # epoch_len = num_samples + min(x_offsets) - max(y_offsets)
+        # t is the index of the last observation.
+        min_t = abs(min(x_offsets))
+        max_t = abs(num_samples - abs(max(y_offsets)))  # Exclusive
+        if as_view:
+            # x and y share the enriched data, unless x has to be scaled
+            data_x = data
+            if scaler is not None:
+                data_x = data.copy()
+                data_x[..., 0] = scaler.transform(data_x[..., 0])
+            x = self._window_view(data_x, x_offsets, min_t, max_t, skip)
+            y = self._window_view(data, y_offsets, min_t, max_t, skip)
+            return x, y
+
+        x = self._stack_windows(data, x_offsets, min_t, max_t, skip)
+        y = self._stack_windows(data, y_offsets, min_t, max_t, skip)
+        if scaler is not None:
+            x[..., 0] = scaler.transform(x[..., 0])
+        return x, y
+
+    @staticmethod
+    def _stack_windows(data, offsets, min_t, max_t, skip=1):
+        """Copies of the windows data[t + offsets], see _window_view"""
+        windows = []
+        for t in range(min_t, max_t, skip):
+            windows.append(data[t + offsets, ...])
+        return np.stack(windows, axis=0)
+
+    @staticmethod
+    def enrich(df, add_time_in_day=True, add_day_in_week=False):
+        """
+        Adds time of day/day of week features to the readings
+        :return: (num_samples, num_nodes, input_dim)
+        """
         num_samples, num_nodes = df.shape
         data = np.expand_dims(df.values, axis=-1)
         feature_list = [data]
@@ -133,61 +287,73 @@ class Dataset():
             dow_tiled = np.tile(dow, [1, num_nodes, 1]).transpose((2, 1, 0))
             feature_list.append(dow_tiled)
 
-        data = np.concatenate(feature_list, axis=-1)
-        # epoch_len = num_samples + min(x_offsets) - max(y_offsets)
-        x, y = [], []
-        # t is the index of the last observation.
-        min_t = abs(min(x_offsets))
-        max_t = abs(num_samples - abs(max(y_offsets)))  # Exclusive
-        for t in range(min_t, max_t, skip):
-            x_t = data[t + x_offsets, ...]
-            y_t = data[t + y_offsets, ...]
-            x.append(x_t)
-            y.append(y_t)
-        x = np.stack(x, axis=0)
-        y = np.stack(y, axis=0)
-        return x, y
+        return np.concatenate(feature_list, axis=-1)
 
-    def generate_train_val_test(self, category='test', add_time_in_day=True, add_day_in_week=False):
-        y_start = 1 #args.y_start
-        seq_length_x, seq_length_y = 12, 12 #args.seq_length_x, args.seq_length_y
+    @staticmethod
+    def _window_view(data, offsets, min_t, max_t, skip=1):
+        """
+        Strided windows over data, window i holds data[min_t + i * skip + offsets].
+        Every window shares memory with data, so the view is read-only.
+        :param data: (num_samples, num_nodes, input_dim)
+        :param offsets: consecutive offsets relative to t
+        :return: (num_windows, len(offsets), num_nodes, input_dim)
+        """
+        offsets = np.asarray(offsets)
+        assert np.all(np.diff(offsets) == 1), 'Strided windows require consecutive offsets'
+        num_windows = len(range(min_t, max_t, skip))
+        stride = data.strides[0]
+        return np.lib.stride_tricks.as_strided(data[min_t + offsets[0]:],
+                                               shape=(num_windows, len(offsets)) + data.shape[1:],
+                                               strides=(stride * skip, stride) + data.strides[1:],
+                                               writeable=False)
+
+    def get_offsets(self):
+        y_start = self.y_start
+        seq_length_x, seq_length_y = self.seq_length_x, self.seq_length_y
 
         # 0 is the latest observed sample., (-11, 1, 1)
         x_offsets = np.sort(np.concatenate((np.arange(-(seq_length_x - 1), 1, 1),)))
         # Predict the next one hour, (1, 13, 1)
         y_offsets = np.sort(np.arange(y_start, (seq_length_y + 1), 1))
+        return x_offsets, y_offsets
 
-        # x: (num_samples, input_length, num_nodes, input_dim)
-        # y: (num_samples, output_length, num_nodes, output_dim)
-
+    def split_range(self, category, num_samples):
+        """:return: slice of the timesteps that belong to category"""
         # Write the data into npz file.
         # num_test = 6831, using the last 6831 examples as testing.
         # for the rest: 7/8 is used for training, and 1/8 is used for validation.
-        train_ratio = 0.7 # args.train_ratio
-        test_ratio = 0.2 # args.test_ratio
+        train_ratio = self.train_ratio
+        test_ratio = self.test_ratio
 
-        sample_padding = seq_length_x + seq_length_y - 1
-        num_samples = self.df.shape[0]
         train_num = round(train_ratio * num_samples)
         test_num = round(test_ratio * num_samples)
         val_num = num_samples - train_num - test_num
 
         # FIXME: Is the order of splitting df a problem?
         if category == 'train':
-            df_sub = self.df[:train_num]
+            return slice(0, train_num)
         elif category == 'val':
-            df_sub = self.df[train_num: train_num + val_num]
+            return slice(train_num, train_num + val_num)
         elif category == 'test':
-            df_sub = self.df[-test_num:]
-        else:
-            df_sub = self.df
+            return slice(num_samples - test_num, num_samples)
+        return slice(0, num_samples)
+
+    def split(self, category='test'):
+        return self.df[self.split_range(category, self.df.shape[0])]
 
-        x, y = self.generate_graph_seq2seq_io_data(
-            df_sub,
+    def generate_train_val_test(self, category='test', add_time_in_day=True, add_day_in_week=False,
+                                as_view=False, scaler=None):
+        # x: (num_samples, input_length, num_nodes, input_dim)
+        # y: (num_samples, output_length, num_nodes, output_dim)
+        x_offsets, y_offsets = self.get_offsets()
+        data = self.get_enriched(category, add_time_in_day=add_time_in_day, add_day_in_week=add_day_in_week)
+
+        x, y = self._seq2seq_from_enriched(
+            data,
             x_offsets=x_offsets,
             y_offsets=y_offsets,
-            add_time_in_day=add_time_in_day,
-            add_day_in_week=add_day_in_week,
+            as_view=as_view,
+            scaler=scaler,
         )
 
         print("x shape: ", x.shape, ", y shape: ", y.shape)
@@ -196,6 +362,20 @@ class Dataset():
 
         return x, y, x_offsets, y_offsets
 
+    def generate_windows(self, category='test', add_time_in_day=True, add_day_in_week=False):
+        """
+        Same samples as generate_train_val_test, but only the enriched data and the
+        index t of the last observation of every sample are returned.
+        :return: data: (num_timesteps, num_nodes, input_dim)
+                 starts: (num_samples,), x = data[starts + x_offsets], y = data[starts + y_offsets]
+        """
+        x_offsets, y_offsets = self.get_offsets()
+        data = self.get_enriched(category, add_time_in_day=add_time_in_day, add_day_in_week=add_day_in_week)
+        min_t = abs(min(x_offsets))
+        max_t = abs(data.shape[0] - abs(max(y_offsets)))  # Exclusive
+        starts = np.arange(min_t, max_t)
+        return data, starts, x_offsets, y_offsets
+
     def get_sensor_coords(self):
         # Prepare sensor coordinates (distance)
         sensor_ids_df = pd.read_csv(os.path.join(self.basedir, 'graph_sensor_locations.csv'),
@@ -224,6 +404,123 @@ class Dataset():
         print('saved', fname)
 
 
+class MemmapDataset(Dataset):
+    def __init__(self, dataset_file, cache_dir=None, chunk_size=2 ** 16):
+        """
+        Dataset for sensor networks that do not fit in memory. The HDF file is converted
+        once to a float32 (timesteps x nodes) memmap with a timestamp sidecar, and
+        windows are gathered from it per batch, so resident memory stays bounded.
+        :param chunk_size: number of timesteps read from the HDF file at once
+        """
+        self.chunk_size = chunk_size
+        self._raw = None
+        self._timestamps = None
+        super().__init__(dataset_file, use_cache=True, cache_dir=cache_dir)
+
+    def _convert(self):
+        key_raw = self.cache.key(array='raw', dtype='float32')
+        key_timestamps = self.cache.key(array='raw_timestamps')
+        raw, timestamps = self.cache.load(key_raw), self.cache.load(key_timestamps)
+        if raw is not None and timestamps is not None:
+            return raw, timestamps
+
+        print('Converting', self.dataset_file, 'to a memmap...')
+        with pd.HDFStore(self.dataset_file, mode='r') as store:
+            key = store.keys()[0]
+            num_samples = hdf_num_rows(store, key)
+            num_nodes = store.select(key, stop=1).shape[1]
+            index = []
+
+            def chunks():
+                for start in range(0, num_samples, self.chunk_size):
+                    df = store.select(key, start=start, stop=start + self.chunk_size)
+                    index.append(df.index.values)
+                    yield df.values.astype(np.float32)
+
+            raw = self.cache.save_chunks(key_raw, (num_samples, num_nodes), np.float32, chunks())
+        timestamps = self.cache.save(key_timestamps, np.concatenate(index))
+        return raw, timestamps
+
+    @property
+    def raw(self):
+        """(num_timesteps, num_nodes) float32 memmap of the readings"""
+        if self._raw is None:
+            self._raw, self._timestamps = self._convert()
+        return self._raw
+
+    @property
+    def timestamps(self):
+        if self._timestamps is None:
+            self._raw, self._timestamps = self._convert()
+        return self._timestamps
+
+    def get_timestamps(self):
+        return pd.DatetimeIndex(np.asarray(self.timestamps), freq='infer')
+
+    def get_enriched(self, category='test', add_time_in_day=True, add_day_in_week=False):
+        split = self.split_range(category, self.raw.shape[0])
+        return EnrichedSeries(self.raw[split], self.timestamps[split],
+                              add_time_in_day=add_time_in_day, add_day_in_week=add_day_in_week)
+
+    def load_category(self, category='val', batch_size=64, pad_with_last_sample=False, add_time_in_day=True,
+                      add_day_in_week=False, **kwargs):
+        # Windows are always gathered from the memmap
+        return self._load_category_lazy(category, batch_size, pad_with_last_sample,
+                                        add_time_in_day, add_day_in_week)
+
+    def num_timesteps(self):
+        return self.raw.shape[0]
+
+    def iter_readings(self, split, chunk_size=2 ** 16):
+        for start in range(split.start, split.stop, chunk_size):
+            yield self.raw[start: min(start + chunk_size, split.stop)]
+
+
+class EnrichedSeries(object):
+    def __init__(self, values, timestamps, add_time_in_day=True, add_day_in_week=False):
+        """
+        Array-like that adds the time of day/day of week features (see Dataset.enrich)
+        to the rows it is indexed with, so the readings can stay in a memmap.
+        :param values: (num_timesteps, num_nodes)
+        :param timestamps: (num_timesteps,) datetime64
+        """
+        self.values = values
+        timestamps = np.asarray(timestamps)
+        features = []
+        if add_time_in_day:
+            features.append((timestamps - timestamps.astype("datetime64[D]")) / np.timedelta64(1, "D"))
+        if add_day_in_week:
+            features.append(pd.DatetimeIndex(timestamps).dayofweek.values)
+        self.features = np.stack(features, axis=-1).astype(values.dtype) if features else None
+        self.shape = values.shape + (1 + len(features),)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, rows):
+        values = np.expand_dims(self.values[rows], axis=-1)
+        if self.features is None:
+            return values
+        features = np.expand_dims(self.features[rows], axis=-2)
+        features = np.broadcast_to(features, values.shape[:-1] + features.shape[-1:])
+        return np.concatenate([values, features], axis=-1)
+
+
+def hdf_num_rows(store, key):
+    storer = store.get_storer(key)
+    return int(storer.nrows if storer.is_table else storer.shape[0])
+
+
+def window_counts(num_timesteps, starts, offsets):
+    """
+    :return: (num_timesteps,) number of windows starts[i] + offsets that contain every timestep
+    """
+    counts = np.zeros(num_timesteps + 1, dtype=np.int64)
+    np.add.at(counts, starts + min(offsets), 1)
+    np.add.at(counts, starts + max(offsets) + 1, -1)
+    return np.cumsum(counts[:-1])
+
+
 class DataLoader(object):
     def __init__(self, xs, ys, batch_size, pad_with_last_sample=False):
         """
@@ -234,36 +531,54 @@ class DataLoader(object):
         :param batch_size:
         :param pad_with_last_sample: pad with the last sample to make number of samples divisible to batch_size.
         """
+        self.xs = xs
+        self.ys = ys
+        self.sensor_mask = None
+        self._init_indices(np.arange(len(xs)), batch_size, pad_with_last_sample)
+
+    def _init_indices(self, indices, batch_size, pad_with_last_sample):
+        # Shuffling and padding only touch the indices, samples are gathered per batch
         self.batch_size = batch_size
         self.current_ind = 0
         if pad_with_last_sample:
-            num_padding = (batch_size - (len(xs) % batch_size)) % batch_size
-            x_padding = np.repeat(xs[-1:], num_padding, axis=0)
-            y_padding = np.repeat(ys[-1:], num_padding, axis=0)
-            xs = np.concatenate([xs, x_padding], axis=0)
-            ys = np.concatenate([ys, y_padding], axis=0)
-        self.size = len(xs)
+            num_padding = (batch_size - (len(indices) % batch_size)) % batch_size
+            indices = np.concatenate([indices, np.repeat(indices[-1:], num_padding)])
+        self.indices = indices
+        self.size = len(indices)
         self.num_batch = int(self.size // self.batch_size)
-        self.xs = xs
-        self.ys = ys
+
+    @property
+    def x_shape(self):
+        """(num_samples, seq_len, num_nodes, input_dim) of the samples, before padding"""
+        return self.xs.shape
 
     def shuffle(self):
         permutation = np.random.permutation(self.size)
-        xs, ys = self.xs[permutation], self.ys[permutation]
-        self.xs = xs
-        self.ys = ys
+        self.indices = self.indices[permutation]
 
     # Set sensor value to 0
     def augment(self, augmentation_matrix):
+        """
+        Loader that shares the data, the sensors are only set to 0 in the batches it yields.
+        :param augmentation_matrix: (num_nodes,) 1 for every disabled sensor
+        """
         # np.random.seed(seed)
         # s_id = np.random.randint(0, self.xs.shape[2])
-        s_id = (augmentation_matrix == 1)
-        new_inst = copy.deepcopy(self)
-        new_inst.xs[:, :, s_id, 0] = 0
-        new_inst.ys[:, :, s_id, 0] = 0
+        new_inst = copy.copy(self)
+        new_inst.sensor_mask = (augmentation_matrix == 1)
         # print ('Setting', str(s_id), 'to 0')
         return new_inst
 
+    def _take(self, indices):
+        return self.xs[indices], self.ys[indices]
+
+    def _gather(self, indices):
+        # _take returns copies, so the mask can be applied in place
+        x, y = self._take(indices)
+        if self.sensor_mask is not None:
+            x[:, :, self.sensor_mask, 0] = 0
+            y[:, :, self.sensor_mask, 0] = 0
+        return x, y
 
     def get_iterator(self):
         self.current_ind = 0
@@ -272,13 +587,83 @@ class DataLoader(object):
             while self.current_ind < self.num_batch:
                 start_ind = self.batch_size * self.current_ind
                 end_ind = min(self.size, self.batch_size * (self.current_ind + 1))
-                x_i = self.xs[start_ind: end_ind, ...]
-                y_i = self.ys[start_ind: end_ind, ...]
+                x_i, y_i = self._gather(self.indices[start_ind: end_ind])
                 yield (x_i, y_i)
                 self.current_ind += 1
 
         return _wrapper()
 
+    def get_augmented_iterator(self, augmentation_matrices):
+        """
+        Yields every batch once for all augmentations, stacked along the batch dimension,
+        so one forward pass covers several disabled sensor sets.
+        :param augmentation_matrices: (num_augmentations, num_nodes), 1 for every disabled sensor
+        :return: x: (num_augmentations * batch_size, ...), block k has augmentation k applied
+                 y: the same for the labels
+        """
+        masks = (np.asarray(augmentation_matrices) == 1)
+        for x_i, y_i in self.get_iterator():
+            yield (self.apply_masks(x_i, masks), self.apply_masks(y_i, masks))
+
+    @staticmethod
+    def apply_masks(batch, masks):
+        """
+        :param batch: (batch_size, seq_len, num_nodes, input_dim)
+        :param masks: (num_masks, num_nodes) bool, sensors set to 0
+        :return: (num_masks * batch_size, seq_len, num_nodes, input_dim)
+        """
+        out = np.repeat(batch[None], len(masks), axis=0)
+        out[..., 0] = np.where(masks[:, None, None, :], 0, out[..., 0])
+        return out.reshape((-1,) + batch.shape[1:])
+
+
+class WindowDataLoader(DataLoader):
+    def __init__(self, data, starts, x_offsets, y_offsets, batch_size, pad_with_last_sample=False, scaler=None):
+        """
+        Same batches as DataLoader, but only the enriched time series and the window
+        positions are kept. Every batch is gathered from data with one fancy index.
+        :param data: (num_timesteps, num_nodes, input_dim) raw values
+        :param starts: index t of the last observation of every sample
+        :param x_offsets: x = data[t + x_offsets]
+        :param y_offsets: y = data[t + y_offsets]
+        :param batch_size:
+        :param pad_with_last_sample: pad with the last sample to make number of samples divisible to batch_size.
+        :param scaler: standardises the first feature of x when a batch is gathered.
+        """
+        self.data = data
+        self.starts = starts
+        self.x_offsets = np.asarray(x_offsets).reshape(-1)
+        self.y_offsets = np.asarray(y_offsets).reshape(-1)
+        self.scaler = scaler
+        self.sensor_mask = None
+        self._init_indices(starts, batch_size, pad_with_last_sample)
+
+    @property
+    def x_shape(self):
+        return (len(self.starts), len(self.x_offsets)) + self.data.shape[1:]
+
+    @property
+    def xs(self):
+        """
+        Every window of the split gathered into a new array, on each access. Unlike the batches, the
+        samples are neither shuffled nor padded. Use x_shape for the shape.
+        """
+        x, _ = self._gather(self.starts)
+        return x
+
+    @property
+    def ys(self):
+        """The labels of every window of the split, gathered like xs."""
+        _, y = self._gather(self.starts)
+        return y
+
+    def _take(self, indices):
+        x = self.data[indices[:, None] + self.x_offsets]
+        y = self.data[indices[:, None] + self.y_offsets]
+        if self.scaler is not None:
+            x[..., 0] = self.scaler.transform(x[..., 0])
+        return x, y
+
 
 class StandardScaler:
     """
@@ -321,11 +706,70 @@ class StandardScaler:
         scaler = StandardScaler(mean=mean, std=std)
         return scaler
 
+    @staticmethod
+    def compute_from_series(chunks, counts=None, per_sensor=False, exclude_unk=False):
+        """
+        Single pass fit over the readings, NaN readings are ignored like in compute_from.
+        :param chunks: iterable of consecutive (num_timesteps, num_nodes) blocks of readings
+        :param counts: (num_timesteps,) weight of every timestep, see window_counts
+        :param per_sensor: mean/std per sensor instead of over all sensors
+        :param exclude_unk: exclude unknown (0) readings
+        """
+        moments = StreamingMoments()
+        offset = 0
+        for chunk in chunks:
+            chunk = np.asarray(chunk, dtype=np.float64)
+            mask = ~np.isnan(chunk)
+            if exclude_unk:
+                mask &= (chunk != 0)
+            weights = mask.astype(np.float64)
+            if counts is not None:
+                weights *= counts[offset: offset + len(chunk), None]
+            offset += len(chunk)
+            moments.update(np.where(mask, chunk, 0.), weights, axis=0 if per_sensor else None)
+        return StandardScaler(mean=moments.mean, std=moments.std)
+
+    @staticmethod
+    def load(f_scaler):
+        """Scaler stored by Dataset next to the dataset file, <dataset_file>.scaler.npz"""
+        with np.load(f_scaler) as ld:
+            return StandardScaler(float(ld['mean']), float(ld['std']))
 
     def inverse_transform(self, data):
         return (data * self.std) + self.mean
 
 
+class StreamingMoments:
+    """
+    Weighted mean and variance over chunks, merged with the parallel algorithm of Chan et al.
+    """
+
+    def __init__(self):
+        self.n = 0.
+        self.mean = 0.
+        self.m2 = 0.
+
+    def update(self, values, weights, axis=None):
+        n = np.sum(weights, axis=axis)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = np.where(n > 0, np.sum(weights * values, axis=axis) / n, 0.)
+        m2 = np.sum(weights * (values - mean) ** 2, axis=axis)
+        self.merge(n, mean, m2)
+
+    def merge(self, n, mean, m2):
+        total = self.n + n
+        delta = mean - self.mean
+        with np.errstate(invalid='ignore', divide='ignore'):
+            self.mean = np.where(total > 0, self.mean + delta * n / total, 0.)
+            self.m2 = np.where(total > 0, self.m2 + m2 + delta ** 2 * self.n * n / total, 0.)
+        self.n = total
+
+    @property
+    def std(self):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.sqrt(self.m2 / self.n)
+
+
 def load_graph_data(pkl_filename):
     sensor_ids, sensor_id_to_ind, adj_mx = load_pickle(pkl_filename)
     return sensor_ids, sensor_id_to_ind, adj_mx
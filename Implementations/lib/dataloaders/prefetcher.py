@@ -0,0 +1,89 @@
+import queue
+import threading
+import time
+
+import torch
+
+
+class Prefetcher(object):
+    _END = object()
+
+    def __init__(self, iterator, transform, num_prefetch=2, device=None, pin_memory=None):
+        """
+        Prepares the next batches in a worker thread while the current step runs.
+        :param iterator: yields numpy batches, e.g. DataLoader.get_iterator()
+        :param transform: fn(*batch) -> tuple of cpu tensors in the layout the model expects
+        :param num_prefetch: number of prepared batches in flight
+        :param device: tensors are moved here when they are taken from the queue
+        :param pin_memory: stage tensors in pinned memory, default when device is a cuda device
+        """
+        self.iterator = iterator
+        self.transform = transform
+        self.num_prefetch = max(1, num_prefetch)
+        self.device = torch.device(device) if device is not None else None
+        if pin_memory is None:
+            pin_memory = self.device is not None and self.device.type == 'cuda'
+        self.pin_memory = pin_memory and torch.cuda.is_available()
+        # Time the worker spent preparing batches and the time the consumer waited for them
+        self.prepare_time = 0.
+        self.wait_time = 0.
+        self._queue = queue.Queue(maxsize=self.num_prefetch)
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def saved_time(self):
+        """Preparation time that overlapped with the consumer instead of stalling it."""
+        return max(0., self.prepare_time - self.wait_time)
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _worker(self):
+        try:
+            for batch in self.iterator:
+                start = time.time()
+                tensors = self.transform(*batch)
+                if self.pin_memory:
+                    tensors = tuple(t.pin_memory() for t in tensors)
+                self.prepare_time += time.time() - start
+                if not self._put(tensors):
+                    return
+        except Exception as e:
+            self._put(e)
+            return
+        self._put(self._END)
+
+    def close(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def __iter__(self):
+        # A new pass starts from a fresh queue, close() of the previous pass has set _stop
+        self.close()
+        self._stop.clear()
+        self._queue = queue.Queue(maxsize=self.num_prefetch)
+        self._thread = threading.Thread(target=self._worker, daemon=True)
+        self._thread.start()
+        try:
+            while True:
+                start = time.time()
+                tensors = self._queue.get()
+                self.wait_time += time.time() - start
+                if tensors is self._END:
+                    break
+                if isinstance(tensors, Exception):
+                    raise tensors
+                if self.device is not None:
+                    tensors = tuple(t.to(self.device, non_blocking=self.pin_memory) for t in tensors)
+                yield tensors
+        finally:
+            self.close()
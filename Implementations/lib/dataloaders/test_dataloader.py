@@ -0,0 +1,156 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+
+from lib.dataloaders.dataloader import Dataset, MemmapDataset, StandardScaler
+from lib.testing import write_synthetic_dataset
+
+
+class DatasetTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.mkdtemp()
+        cls.dataset_file = write_synthetic_dataset(os.path.join(cls.tmpdir, 'test.h5'), missing_ratio=0.1)
+        cls.ds = Dataset(cls.dataset_file)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmpdir)
+
+    def test_window_views_equal_copies(self):
+        for category in ['train', 'val', 'test']:
+            x, y, _, _ = self.ds.generate_train_val_test(category, scaler=self.ds.scaler)
+            x_view, y_view, _, _ = self.ds.generate_train_val_test(category, as_view=True, scaler=self.ds.scaler)
+            np.testing.assert_array_equal(x, x_view)
+            np.testing.assert_array_equal(y, y_view)
+
+    def test_window_views_share_memory(self):
+        x, y, _, _ = self.ds.generate_train_val_test('val', as_view=True)
+        self.assertFalse(x.flags.writeable)
+        self.assertTrue(np.shares_memory(x, y))
+        # Consecutive windows overlap in all but one timestep
+        np.testing.assert_array_equal(x[0, 1:], x[1, :-1])
+
+    def test_load_category_as_view(self):
+        loader = self.ds.load_category('test', batch_size=16, as_view=True)
+        x, y, _, _ = self.ds.generate_train_val_test('test', scaler=self.ds.scaler)
+        batches = list(loader.get_iterator())
+        self.assertEqual(loader.num_batch, len(batches))
+        np.testing.assert_array_equal(x[:16], batches[0][0])
+        np.testing.assert_array_equal(y[:16], batches[0][1])
+
+    def test_lazy_loader_equals_loader(self):
+        loader = self.ds.load_category('val', batch_size=8, pad_with_last_sample=True)
+        lazy_loader = self.ds.load_category('val', batch_size=8, pad_with_last_sample=True, lazy=True)
+        self.assertEqual(loader.num_batch, lazy_loader.num_batch)
+        for (x, y), (lazy_x, lazy_y) in zip(loader.get_iterator(), lazy_loader.get_iterator()):
+            np.testing.assert_array_equal(x, lazy_x)
+            np.testing.assert_array_equal(y, lazy_y)
+
+    def test_lazy_loader_shuffle(self):
+        loader = self.ds.load_category('val', batch_size=8)
+        lazy_loader = self.ds.load_category('val', batch_size=8, lazy=True)
+        data = lazy_loader.data
+        np.random.seed(1)
+        loader.shuffle()
+        np.random.seed(1)
+        lazy_loader.shuffle()
+        # Only the window positions are permuted
+        self.assertIs(data, lazy_loader.data)
+        for (x, y), (lazy_x, lazy_y) in zip(loader.get_iterator(), lazy_loader.get_iterator()):
+            np.testing.assert_array_equal(x, lazy_x)
+            np.testing.assert_array_equal(y, lazy_y)
+
+    def test_augment(self):
+        mask = np.array([0, 1, 0, 0, 1])
+        for lazy in [False, True]:
+            loader = self.ds.load_category('val', batch_size=8, lazy=lazy)
+            x_all, y_all = loader.xs.copy(), loader.ys.copy()
+            self.assertEqual(loader.x_shape, x_all.shape)
+            x_all[:, :, mask == 1, 0] = 0
+            y_all[:, :, mask == 1, 0] = 0
+            augmented = loader.augment(mask)
+            self.assertIsNone(loader.sensor_mask)
+            # The data is shared, only the batches are masked
+            self.assertIs(getattr(loader, 'data', loader.xs), getattr(augmented, 'data', augmented.xs))
+            x, y = zip(*augmented.get_iterator())
+            num_samples = loader.num_batch * loader.batch_size
+            np.testing.assert_array_equal(x_all[:num_samples], np.concatenate(x))
+            np.testing.assert_array_equal(y_all[:num_samples], np.concatenate(y))
+
+    def test_augmented_iterator(self):
+        masks = np.eye(5)[[0, 3, 4]]
+        loader = self.ds.load_category('val', batch_size=8, lazy=True)
+        for k, mask in enumerate(masks):
+            for (x, y), (x_stacked, y_stacked) in zip(loader.augment(mask).get_iterator(),
+                                                      loader.get_augmented_iterator(masks)):
+                batch_size = len(x)
+                np.testing.assert_array_equal(x, x_stacked[k * batch_size: (k + 1) * batch_size])
+                np.testing.assert_array_equal(y, y_stacked[k * batch_size: (k + 1) * batch_size])
+
+    def test_cached_windows(self):
+        x, y, _, _ = self.ds.generate_train_val_test('val', scaler=self.ds.scaler)
+        ds = Dataset(self.dataset_file)
+        ds.load_category('val', batch_size=8)
+        # Served from the memory-mapped cache, the HDF file is not read again
+        self.assertIsNone(ds._df)
+        self.assertIsInstance(ds.get_enriched('val'), np.memmap)
+        np.testing.assert_array_equal(x, ds.data['x_val'])
+        np.testing.assert_array_equal(y, ds.data['y_val'])
+
+    def test_warm_start_windows(self):
+        categories = ['train', 'val', 'test']
+        expected = [list(self.ds.load_category(c, batch_size=8, as_view=False).get_iterator()) for c in categories]
+        ds = Dataset(self.dataset_file)
+        with mock.patch.object(Dataset, '_stack_windows') as stack_windows, \
+                mock.patch.object(Dataset, 'enrich') as enrich:
+            loaders = [ds.load_category(c, batch_size=8) for c in categories]
+        # Views over the cached splits, no window is generated
+        stack_windows.assert_not_called()
+        enrich.assert_not_called()
+        for loader, batches in zip(loaders, expected):
+            self.assertFalse(loader.xs.flags.writeable)
+            for (x, y), (expected_x, expected_y) in zip(loader.get_iterator(), batches):
+                np.testing.assert_array_equal(x, expected_x)
+                np.testing.assert_array_equal(y, expected_y)
+
+    def test_memmap_dataset(self):
+        ds = MemmapDataset(self.dataset_file, cache_dir=os.path.join(self.tmpdir, 'memmap'), chunk_size=64)
+        self.assertEqual(np.float32, ds.raw.dtype)
+        self.assertIsInstance(ds.raw, np.memmap)
+        lazy_loader = self.ds.load_category('test', batch_size=8, lazy=True)
+        memmap_loader = ds.load_category('test', batch_size=8)
+        for (x, y), (memmap_x, memmap_y) in zip(lazy_loader.get_iterator(), memmap_loader.get_iterator()):
+            np.testing.assert_allclose(x, memmap_x, rtol=1e-5, atol=1e-5)
+            np.testing.assert_allclose(y, memmap_y, rtol=1e-5, atol=1e-5)
+        self.assertIsNone(ds._df)
+
+    def test_memmap_dataset_scaler(self):
+        x_train, _, _, _ = self.ds.generate_train_val_test('train')
+        expected = StandardScaler.compute_from(x_train)
+        scaler = MemmapDataset(self.dataset_file, cache_dir=os.path.join(self.tmpdir, 'memmap'))._compute_scaler()
+        self.assertAlmostEqual(expected.mean[0], scaler.mean, delta=1e-5)
+        self.assertAlmostEqual(expected.std[0], scaler.std, delta=1e-5)
+
+    def test_streaming_scaler(self):
+        x_train, _, _, _ = self.ds.generate_train_val_test('train')
+        for kwargs in [{}, {'exclude_unk': True}, {'round_to_days': True}]:
+            expected = StandardScaler.compute_from(x_train.copy(), samples_per_hour=1, **kwargs)
+            scaler = self.ds.compute_scaler(samples_per_hour=1, chunk_size=50, **kwargs)
+            self.assertAlmostEqual(expected.mean[0], scaler.mean, delta=1e-8)
+            self.assertAlmostEqual(expected.std[0], scaler.std, delta=1e-8)
+
+    def test_streaming_scaler_per_sensor(self):
+        x_train, _, _, _ = self.ds.generate_train_val_test('train')
+        x_train = x_train[..., 0].reshape(-1, x_train.shape[2])
+        scaler = self.ds.compute_scaler(per_sensor=True, chunk_size=50)
+        np.testing.assert_allclose(np.nanmean(x_train, axis=0), scaler.mean)
+        np.testing.assert_allclose(np.nanstd(x_train, axis=0), scaler.std)
+
+
+if __name__ == '__main__':
+    unittest.main()
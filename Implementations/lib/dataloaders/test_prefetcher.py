@@ -0,0 +1,76 @@
+import time
+import unittest
+
+import numpy as np
+import torch
+
+from lib.dataloaders.prefetcher import Prefetcher
+
+
+def to_tensors(x, y):
+    return torch.from_numpy(x), torch.from_numpy(y)
+
+
+class PrefetcherTestCase(unittest.TestCase):
+    def setUp(self):
+        self.batches = [(np.full((2, 3), i, dtype=np.float32), np.full((2, 1), -i, dtype=np.float32))
+                        for i in range(10)]
+
+    def test_batch_order(self):
+        prefetcher = Prefetcher(iter(self.batches), to_tensors, num_prefetch=3)
+        batches = list(prefetcher)
+        self.assertEqual(len(batches), len(self.batches))
+        for (x, y), (expected_x, expected_y) in zip(batches, self.batches):
+            np.testing.assert_array_equal(x.numpy(), expected_x)
+            np.testing.assert_array_equal(y.numpy(), expected_y)
+
+    def test_reiterate(self):
+        prefetcher = Prefetcher(self.batches, to_tensors)
+        self.assertEqual(len(list(prefetcher)), len(self.batches))
+        self.assertEqual(len(list(prefetcher)), len(self.batches))
+
+    def test_worker_exception(self):
+        def transform(x, y):
+            if x[0, 0] == 3:
+                raise ValueError('bad batch')
+            return to_tensors(x, y)
+
+        seen = []
+        with self.assertRaises(ValueError):
+            for x, _ in Prefetcher(iter(self.batches), transform):
+                seen.append(int(x[0, 0]))
+        self.assertEqual(seen, [0, 1, 2])
+
+    def test_early_break_joins_worker(self):
+        prefetcher = Prefetcher(iter(self.batches), to_tensors, num_prefetch=1)
+        iterator = iter(prefetcher)
+        next(iterator)
+        thread = prefetcher._thread
+        self.assertTrue(thread.is_alive())
+        iterator.close()
+        self.assertFalse(thread.is_alive())
+        self.assertIsNone(prefetcher._thread)
+
+    def test_timing(self):
+        def slow_transform(x, y):
+            time.sleep(0.02)
+            return to_tensors(x, y)
+
+        # A consumer faster than the worker waits for every batch, nothing is saved
+        prefetcher = Prefetcher(iter(self.batches), slow_transform)
+        list(prefetcher)
+        self.assertGreaterEqual(prefetcher.prepare_time, 0.2)
+        self.assertGreater(prefetcher.wait_time, 0.1)
+        self.assertEqual(prefetcher.saved_time, max(0., prefetcher.prepare_time - prefetcher.wait_time))
+        self.assertLess(prefetcher.saved_time, 0.1)
+
+        # A slower consumer overlaps with the worker, only the first batch is waited for
+        prefetcher = Prefetcher(iter(self.batches), slow_transform)
+        for _ in prefetcher:
+            time.sleep(0.04)
+        self.assertLess(prefetcher.wait_time, 0.1)
+        self.assertGreater(prefetcher.saved_time, 0.1)
+
+
+if __name__ == '__main__':
+    unittest.main()
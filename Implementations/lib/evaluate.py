@@ -2,6 +2,8 @@ import numpy as np
 from tqdm import tqdm
 import tensorflow as tf
 
+from lib.ablation import SensorAblation, single_sensor_masks
+
 def compute_preds(self, sess, model, data_generator):
     y_reals = []
     outputs = []
@@ -29,36 +31,27 @@ def compute_preds(self, sess, model, data_generator):
     return y_preds, y_reals
 
 
-def evaluate_multiple(supervisor, sess, data, model, output_filename, category='val', **kwargs):
+def evaluate_multiple(supervisor, sess, data, model, output_filename, category='val', checkpoint_file=None,
+                      **kwargs):
     # Augmentation pattern, disable all sensors individually
     dis_sensors = range(206) #[189, 200]
-    all_preds = []
-    # Make global
-    # y_truths = []
-    scaler = data['scaler']
+    output_dim = supervisor._model_kwargs.get('output_dim')
     loader = data[category + '_loader']
-    # y_truths = data['y_' + category][:, :, :, 0]
-
-    y_preds, y_reals = compute_preds(supervisor, sess, model, loader.get_iterator())
-
-    for idx, s in tqdm(enumerate(dis_sensors)):
-        augmentation_matrix = np.zeros(207)
-        augmentation_matrix[s] = 1
-
-        # Generate augmented datasets
-        augmented_dataloader = loader.augment(augmentation_matrix)
-        # Do inference
-        aug_preds, _ = compute_preds(supervisor, sess, model, augmented_dataloader.get_iterator())
-        print('results ', s, 'computed')
-        # relative_err = MAPE(normal) - MAPE(augmented)
-        #  mae error per sensor before - error per sensor after
-        err_rel = (y_reals != 0).astype(np.uint8) * (np.abs(y_preds - y_reals) - np.abs(aug_preds - y_reals))
-        # Scale relative_err per 'frame' with softmax, then average over time.
-        all_preds.append(err_rel)
-        print(err_rel.shape)
 
-    pred_mx = np.stack(all_preds)
+    def predict(x, y):
+        feed_dict = {
+            model.inputs: x,
+            model.labels: y,
+        }
+        return sess.run(model.outputs, feed_dict=feed_dict)
+
+    # relative_err = MAPE(normal) - MAPE(augmented)
+    #  mae error per sensor before - error per sensor after, summed per disabled sensor while the batches stream by
+    # One mask per pass, the placeholders of the TF model have a fixed batch size
+    ablation = SensorAblation(predict, single_sensor_masks(dis_sensors, 207), checkpoint_file=checkpoint_file)
+    # The labels are fed as well, the predictions do not depend on them
+    batches = ((x, y, y) for x, y in loader.get_iterator())
     # Aggregate over time
-    pred_mx = np.sum(pred_mx, axis=1) / pred_mx.shape[1]
+    pred_mx = ablation.run(tqdm(batches, total=loader.num_batch), labels=lambda y: y[..., :output_dim])
     print(pred_mx.shape)
     np.savez('data/metr-la/results/dcrnn_preds', pred_mx)
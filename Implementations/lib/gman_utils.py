@@ -1,4 +1,5 @@
 import numpy as np
+import pandas as pd
 
 # log string
 from lib.dataloaders.dataloader import Dataset
@@ -15,9 +16,9 @@ def seq2instance(data, num_his, num_pred):
 
 def loadData(args):
     ds = Dataset(args.traffic_file)
-    ds.load_category('train', args.batch_size, add_time_in_day=False, add_day_in_week=False)
-    ds.load_category('val', args.batch_size, add_time_in_day=False, add_day_in_week=False)
-    ds.load_category('test', args.batch_size, add_time_in_day=False, add_day_in_week=False)
+    ds.load_category('train', args.batch_size, add_time_in_day=False, add_day_in_week=False, as_view=True)
+    ds.load_category('val', args.batch_size, add_time_in_day=False, add_day_in_week=False, as_view=True)
+    ds.load_category('test', args.batch_size, add_time_in_day=False, add_day_in_week=False, as_view=True)
 
     # train/val/test
     sample_padding = args.num_his + args.num_pred - 1
@@ -42,11 +43,11 @@ def loadData(args):
         SE[index] = temp[1 :]
         
     # temporal embedding 
-    Time = ds.df.index
-    dayofweek = np.reshape(Time.weekday, newshape = (-1, 1))
+    Time = ds.get_timestamps()
+    dayofweek = np.reshape(Time.weekday, (-1, 1))
     timeofday = (Time.hour * 3600 + Time.minute * 60 + Time.second) \
-                // Time.freq.delta.total_seconds()
-    timeofday = np.reshape(timeofday, newshape = (-1, 1))    
+                // pd.Timedelta(Time.freq).total_seconds()
+    timeofday = np.reshape(timeofday, (-1, 1))    
     Time = np.concatenate((dayofweek, timeofday), axis = -1)
     # train/val/test
     train = Time[: train_steps]
@@ -0,0 +1,74 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from lib.ablation import SensorAblation, single_sensor_masks
+from lib.dataloaders.dataloader import DataLoader
+
+
+def predict(x):
+    # Mixes the sensors, so every disabled sensor changes the predictions of all sensors
+    return np.tanh(x[..., 0] + 0.5 * x[..., 0].mean(axis=2, keepdims=True)).transpose(0, 2, 1)
+
+
+def labels(y):
+    return y[..., 0].transpose(0, 2, 1)
+
+
+class SensorAblationTestCase(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        xs = rng.randn(50, 4, 6, 2).astype(np.float32)
+        ys = rng.randn(50, 4, 6, 2).astype(np.float32)
+        ys[rng.rand(*ys.shape) < 0.2] = 0
+        self.loader = DataLoader(xs, ys, 8, pad_with_last_sample=True)
+        self.masks = single_sensor_masks(range(5), 6)
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def expected(self):
+        x, y = zip(*self.loader.get_iterator())
+        preds, realy = predict(np.concatenate(x)), labels(np.concatenate(y))
+        all_preds = []
+        for mask in self.masks:
+            aug_x, _ = zip(*self.loader.augment(mask).get_iterator())
+            aug_preds = predict(np.concatenate(aug_x))
+            all_preds.append((realy != 0).astype(np.uint8) * (np.abs(preds - realy) - np.abs(aug_preds - realy)))
+        pred_mx = np.stack(all_preds)
+        return np.sum(pred_mx, axis=1) / pred_mx.shape[1]
+
+    def test_bit_identical(self):
+        expected = self.expected()
+        for masks_per_pass in [1, 2, 5]:
+            ablation = SensorAblation(predict, self.masks, masks_per_pass=masks_per_pass)
+            pred_mx = ablation.run(self.loader.get_iterator(), labels=labels)
+            self.assertEqual(expected.dtype, pred_mx.dtype)
+            np.testing.assert_array_equal(expected, pred_mx)
+
+    def test_resume(self):
+        checkpoint_file = os.path.join(self.tmpdir, 'ablation.npz')
+        ablation = SensorAblation(predict, self.masks, masks_per_pass=2, checkpoint_file=checkpoint_file)
+        for x, y in list(self.loader.get_iterator())[:3]:
+            ablation.process_batch(x, y, labels=labels)
+        ablation.save()
+
+        calls = []
+
+        def counting_predict(x):
+            calls.append(len(x))
+            return predict(x)
+
+        resumed = SensorAblation(counting_predict, self.masks, masks_per_pass=2, checkpoint_file=checkpoint_file)
+        pred_mx = resumed.run(self.loader.get_iterator(), labels=labels)
+        np.testing.assert_array_equal(self.expected(), pred_mx)
+        # Only the remaining batches are computed
+        self.assertEqual((self.loader.num_batch - 3) * 4, len(calls))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,45 @@
+import argparse
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from lib.dataloaders.dataloader import Dataset
+from lib.gman_utils import loadData
+from lib.testing import write_synthetic_dataset
+
+
+class LoadDataTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        traffic_file = write_synthetic_dataset(os.path.join(self.tmpdir, 'test.h5'))
+        rng = np.random.RandomState(0)
+        se_file = os.path.join(self.tmpdir, 'SE.txt')
+        with open(se_file, 'w') as f:
+            f.write('5 4\n' + ''.join('%d %s\n' % (i, ' '.join(map(str, rng.randn(4)))) for i in range(5)))
+        self.args = argparse.Namespace(traffic_file=traffic_file, SE_file=se_file, batch_size=16,
+                                       num_his=12, num_pred=12)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_window_views(self):
+        trainX, trainTE, trainY, valX, valTE, valY, testX, testTE, testY, SE, mean, std, _ = loadData(self.args)
+        # The windows are read-only views of the series, unchanged against copied windows
+        ds = Dataset(self.args.traffic_file)
+        for category, x, y, te in [('train', trainX, trainY, trainTE), ('val', valX, valY, valTE),
+                                   ('test', testX, testY, testTE)]:
+            expected_x, expected_y, _, _ = ds.generate_train_val_test(category, add_time_in_day=False,
+                                                                      add_day_in_week=False, scaler=ds.scaler)
+            self.assertFalse(x.flags.writeable)
+            np.testing.assert_array_equal(x, np.squeeze(expected_x, axis=3))
+            np.testing.assert_array_equal(y, np.squeeze(expected_y, axis=3))
+            self.assertEqual(te.shape, (x.shape[0], 24, 2))
+        self.assertEqual(SE.shape, (5, 4))
+        self.assertEqual((mean, std), (ds.scaler.mean, ds.scaler.std))
+
+
+if __name__ == '__main__':
+    unittest.main()
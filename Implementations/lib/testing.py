@@ -0,0 +1,38 @@
+import numpy as np
+import pandas as pd
+
+from lib import utils
+
+
+def synthetic_readings(num_timesteps=400, num_nodes=5, start='2012-03-01', missing_ratio=0., seed=0):
+    """
+    Uniform readings every 5 minutes, a (timestamps x sensors) DataFrame like the datasets.
+    :param missing_ratio: share of the readings set to 0, the unknown value
+    """
+    rng = np.random.RandomState(seed)
+    index = pd.date_range(start, periods=num_timesteps, freq='5min')
+    values = rng.uniform(0, 70, (len(index), num_nodes))
+    if missing_ratio:
+        values[rng.rand(*values.shape) < missing_ratio] = 0
+    return pd.DataFrame(values, index=index)
+
+
+def write_synthetic_dataset(dataset_file, **kwargs):
+    """
+    Stores synthetic_readings(**kwargs) as an HDF dataset.
+    :return: dataset_file
+    """
+    synthetic_readings(**kwargs).to_hdf(dataset_file, key='df')
+    return dataset_file
+
+
+def random_supports(num_nodes=20, degree=3, adjtype='dual_random_walk'):
+    """
+    Supports of a utils.random_graph, as utils.load_adj builds them.
+    :param adjtype: 'dual_random_walk' (DCRNN) or 'doubletransition' (Graph WaveNet)
+    """
+    adj_mx = utils.random_graph(num_nodes, degree)
+    if adjtype == 'doubletransition':
+        return [utils.asym_adj(adj_mx), utils.asym_adj(np.transpose(adj_mx))]
+    return [np.transpose(utils.calculate_random_walk_matrix(adj_mx)),
+            np.transpose(utils.calculate_random_walk_matrix(np.transpose(adj_mx)))]
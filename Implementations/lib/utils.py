@@ -22,6 +22,15 @@ def asym_adj(adj):
     d_mat= sp.diags(d_inv)
     return d_mat.dot(adj).astype(np.float32).todense()
 
+def random_graph(num_nodes, degree=8, seed=0):
+    """Synthetic sensor graph with `degree` random neighbours per node."""
+    rng = np.random.RandomState(seed)
+    rows = np.repeat(np.arange(num_nodes), degree)
+    cols = rng.randint(0, num_nodes, num_nodes * degree)
+    adj_mx = sp.coo_matrix((rng.rand(len(rows)), (rows, cols)), shape=(num_nodes, num_nodes)).toarray()
+    np.fill_diagonal(adj_mx, 1)
+    return adj_mx.astype(np.float32)
+
 def calculate_normalized_laplacian(adj):
     """
     # L = D^-1/2 (D-A) D^-1/2 = I - D^-1/2 A D^-1/2
@@ -113,10 +122,12 @@ def load_adj(pkl_filename, adjtype):
         assert error, "adj type not defined"
     return sensor_ids, sensor_id_to_ind, adj
 
-def load_dataset(dataset_file, batch_size, val_batch_size=None, test_batch_size=None, **kwargs):
-    ds = Dataset(dataset_file)
-    ds.load_category('train', batch_size)
+def load_dataset(dataset_file, batch_size, val_batch_size=None, test_batch_size=None, as_view=None, lazy=False,
+                 memmap=False, **kwargs):
+    # memmap serves the windows from a float32 memmap of the readings, for networks larger than RAM
+    ds = MemmapDataset(dataset_file) if memmap else Dataset(dataset_file)
+    ds.load_category('train', batch_size, as_view=as_view, lazy=lazy)
     ds.data['train_loader'].shuffle()
-    ds.load_category('val', val_batch_size)
-    ds.load_category('test', test_batch_size)
+    ds.load_category('val', val_batch_size, as_view=as_view, lazy=lazy)
+    ds.load_category('test', test_batch_size, as_view=as_view, lazy=lazy)
     return ds
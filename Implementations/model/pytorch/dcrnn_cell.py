@@ -1,4 +1,5 @@
 import numpy as np
+import scipy.sparse as sp
 import torch
 
 from lib import utils
@@ -6,6 +7,21 @@ from lib import utils
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
 
+def _autocast_enabled(device_type):
+    """
+    torch.is_autocast_enabled(device_type) on the torch versions of requirements.txt: torch.autocast exists
+    from torch 1.10, the device_type argument from torch 2.4.
+    """
+    if not hasattr(torch, 'autocast'):
+        return False
+    try:
+        return torch.is_autocast_enabled(device_type)
+    except TypeError:
+        if device_type == 'cpu':
+            return torch.is_autocast_cpu_enabled()
+        return torch.is_autocast_enabled()
+
+
 class LayerParams:
     def __init__(self, rnn_network: torch.nn.Module, layer_type: str):
         self._rnn_network = rnn_network
@@ -35,7 +51,8 @@ class LayerParams:
 
 class DCGRUCell(torch.nn.Module):
     def __init__(self, num_units, supports, max_diffusion_step, num_nodes, nonlinearity='tanh',
-                 filter_type="laplacian", use_gc_for_ru=True):
+                 filter_type="laplacian", use_gc_for_ru=True, sparse_format='coo', stack_supports=False,
+                 reuse_input_diffusion=False, input_dim=None):
         """
 
         :param num_units:
@@ -45,6 +62,13 @@ class DCGRUCell(torch.nn.Module):
         :param nonlinearity:
         :param filter_type: "laplacian", "random_walk", "dual_random_walk".
         :param use_gc_for_ru: whether to use Graph convolution to calculate the reset and update gates.
+        :param sparse_format: "coo" or "csr", storage of the supports. csr is the faster format for SpMM on CPU.
+        :param stack_supports: diffuse with all supports that share an input in a single SpMM,
+               with the supports stacked vertically into one matrix.
+        :param reuse_input_diffusion: diffuse the inputs once per step for both graph convolutions,
+               only the state is diffused separately for the gates and the candidate.
+        :param input_dim: features per node of the inputs. If given, the parameters are registered right away,
+               otherwise on the first forward pass.
         """
 
         super().__init__()
@@ -55,6 +79,9 @@ class DCGRUCell(torch.nn.Module):
         self._max_diffusion_step = max_diffusion_step
         self._supports = []
         self._use_gc_for_ru = use_gc_for_ru
+        self._reuse_input_diffusion = reuse_input_diffusion and use_gc_for_ru
+        # Selects the state rows of the gconv weights, set by project_inputs if not given
+        self._input_dim = input_dim
 
         # supports = []
         # if filter_type == "laplacian":
@@ -67,29 +94,103 @@ class DCGRUCell(torch.nn.Module):
         # else:
         #     supports.append(utils.calculate_scaled_laplacian(adj_mx))
         for support in supports:
-            self._supports.append(self._build_sparse_matrix(support))
+            self._supports.append(self._build_sparse_matrix(support, sparse_format))
+        self._rounds = None
+        self._stacked_supports = {}
+        if stack_supports:
+            self._rounds = self._diffusion_rounds(len(supports), max_diffusion_step)
+            for lo, hi, _, _ in self._rounds:
+                if (lo, hi) not in self._stacked_supports:
+                    self._stacked_supports[(lo, hi)] = self._build_sparse_matrix(
+                        sp.vstack([sp.coo_matrix(support) for support in supports[lo:hi]]), sparse_format)
 
         self._fc_params = LayerParams(self, 'fc')
         self._gconv_params = LayerParams(self, 'gconv')
+        # Diffusion stacks reused across calls when no gradient is recorded, keyed by shape, dtype and device
+        self._workspace = {}
+        if input_dim is not None:
+            self._register_parameters(input_dim)
+
+    def _register_parameters(self, input_dim):
+        """Creates the parameters in the order the first forward pass would, so checkpoints keep their layout."""
+        input_size = input_dim + self._num_units
+        num_matrices = len(self._supports) * self._max_diffusion_step + 1
+        if self._use_gc_for_ru:
+            self._gconv_params.get_weights((input_size * num_matrices, 2 * self._num_units))
+            self._gconv_params.get_biases(2 * self._num_units, bias_start=1.0)
+        else:
+            self._fc_params.get_weights((input_size, 2 * self._num_units))
+            self._fc_params.get_biases(2 * self._num_units, bias_start=1.0)
+        self._gconv_params.get_weights((input_size * num_matrices, self._num_units))
+        self._gconv_params.get_biases(self._num_units)
 
     @staticmethod
-    def _build_sparse_matrix(L):
+    def _build_sparse_matrix(L, sparse_format='coo'):
+        if sparse_format == 'csr':
+            L = sp.csr_matrix(L)
+            L.sort_indices()
+            return torch.sparse_csr_tensor(torch.from_numpy(L.indptr.astype(np.int64)),
+                                           torch.from_numpy(L.indices.astype(np.int64)),
+                                           torch.from_numpy(L.data), L.shape, device=device)
         L = L.tocoo()
         indices = np.column_stack((L.row, L.col))
         # this is to ensure row-major ordering to equal torch.sparse.sparse_reorder(L)
-        indices = indices[np.lexsort((indices[:, 0], indices[:, 1]))]
-        L = torch.sparse_coo_tensor(indices.T, L.data, L.shape, device=device)
+        order = np.lexsort((indices[:, 0], indices[:, 1]))
+        L = torch.sparse_coo_tensor(indices[order].T, L.data[order], L.shape, device=device)
         return L
 
-    def forward(self, inputs, hx):
+    @staticmethod
+    def _diffusion_rounds(num_supports, max_diffusion_step):
+        """
+        Groups the diffusion orders into rounds of SpMMs with a shared input.
+        Support s starts from the second to last order of support s - 1 (x0 and x1 are carried over
+        between supports), so its first order shares the input of the last order of support s - 1.
+        :return: list of (lo, hi, in_index, [(out_index, prev_index), ...]): supports[lo:hi] are
+                 applied to stack[in_index], the results are stack[out_index] for consecutive out_index,
+                 prev_index is the order subtracted from 2 * support @ x1, None for the first order.
+        """
+        rounds = {}
+        for s in range(num_supports if max_diffusion_step > 0 else 0):
+            base = 0 if s == 0 or max_diffusion_step == 1 else s * max_diffusion_step - 1
+            for k in range(1, max_diffusion_step + 1):
+                out = 1 + s * max_diffusion_step + k - 1
+                if k == 1:
+                    x_in, prev = base, None
+                else:
+                    x_in, prev = out - 1, (base if k == 2 else out - 2)
+                r = s * (max_diffusion_step - 1) + k - 1
+                rounds.setdefault(r, []).append((s, x_in, out, prev))
+        result = []
+        for r in sorted(rounds):
+            ops = rounds[r]
+            assert len(set(x_in for _, x_in, _, _ in ops)) == 1
+            result.append((ops[0][0], ops[-1][0] + 1, ops[0][1], [(out, prev) for _, _, out, prev in ops]))
+        return result
+
+    def forward(self, inputs, hx, input_projection=None):
         """Gated recurrent unit (GRU) with Graph Convolution.
         :param inputs: (B, num_nodes * input_dim)
         :param hx: (B, num_nodes * rnn_units)
+        :param input_projection: project_inputs(inputs), optional, computed when reuse_input_diffusion is set
 
         :return
         - Output: A `2-D` tensor with shape `(B, num_nodes * rnn_units)`.
         """
         output_size = 2 * self._num_units
+        if input_projection is None and self._reuse_input_diffusion:
+            input_projection = self.project_inputs(inputs)
+        if input_projection is not None:
+            gates_projection, candidate_projection = input_projection
+            value = torch.sigmoid(self._gconv_state(hx, gates_projection, output_size))
+            value = torch.reshape(value, (-1, self._num_nodes, output_size))
+            r, u = torch.split(tensor=value, split_size_or_sections=self._num_units, dim=-1)
+            r = torch.reshape(r, (-1, self._num_nodes * self._num_units))
+            u = torch.reshape(u, (-1, self._num_nodes * self._num_units))
+            c = self._gconv_state(r * hx, candidate_projection, self._num_units)
+            if self._activation is not None:
+                c = self._activation(c)
+            return u * hx + (1.0 - u) * c
+
         if self._use_gc_for_ru:
             fn = self._gconv
         else:
@@ -107,11 +208,6 @@ class DCGRUCell(torch.nn.Module):
         new_state = u * hx + (1.0 - u) * c
         return new_state
 
-    @staticmethod
-    def _concat(x, x_):
-        x_ = x_.unsqueeze(0)
-        return torch.cat([x, x_], dim=0)
-
     def _fc(self, inputs, state, output_size, bias_start=0.0):
         batch_size = inputs.shape[0]
         inputs = torch.reshape(inputs, (batch_size * self._num_nodes, -1))
@@ -124,40 +220,147 @@ class DCGRUCell(torch.nn.Module):
         value += biases
         return value
 
+    def _get_workspace(self, shape, like):
+        key = (shape, like.dtype, like.device)
+        if key not in self._workspace:
+            self._workspace[key] = torch.empty(shape, dtype=like.dtype, device=like.device)
+        return self._workspace[key]
+
+    def _diffusion_stack(self, *parts):
+        """
+        Diffuses the concatenation of parts with all supports, fused into a single preallocated stack.
+        :param parts: (batch_size, num_nodes, dim) each, e.g. inputs and state
+        :return: (num_matrices, num_nodes, input_size * batch_size), columns ordered (input_size, batch_size)
+        """
+        device_type = parts[0].device.type
+        if _autocast_enabled(device_type):
+            # The diffusion error grows with every order and reduced precision SpMM kernels are missing on
+            # some backends, so only the dense projections of the stack run in the autocast dtype
+            with torch.autocast(device_type, enabled=False):
+                return self._diffusion_stack(*[part.float() for part in parts])
+
+        batch_size = parts[0].size(0)
+        input_size = sum(part.size(2) for part in parts)
+        num_matrices = len(self._supports) * self._max_diffusion_step + 1  # Adds for x itself.
+        shape = (num_matrices, self._num_nodes, input_size * batch_size)
+
+        if torch.is_grad_enabled() and any(part.requires_grad for part in parts):
+            # Autograd does not support writing into out=, every order is a new tensor and stacked once
+            x0 = torch.cat(parts, dim=2).permute(1, 2, 0)  # (num_nodes, total_arg_size, batch_size)
+            x0 = torch.reshape(x0, shape=[self._num_nodes, input_size * batch_size])
+            x = [x0]
+            if self._rounds is not None:
+                for lo, hi, x_in, ops in self._rounds:
+                    y = torch.sparse.mm(self._stacked_supports[(lo, hi)], x[x_in])
+                    for y_s, (out, prev) in zip(torch.split(y, self._num_nodes), ops):
+                        x.append(y_s if prev is None else 2 * y_s - x[prev])
+            elif self._max_diffusion_step > 0:
+                for support in self._supports:
+                    x1 = torch.sparse.mm(support, x0)
+                    x.append(x1)
+                    for k in range(2, self._max_diffusion_step + 1):
+                        x2 = 2 * torch.sparse.mm(support, x1) - x0
+                        x.append(x2)
+                        x1, x0 = x2, x1
+            return torch.stack(x)
+
+        if torch.is_grad_enabled():
+            # Autograd may keep a view of the stack for the weight gradient
+            x = torch.empty(shape, dtype=parts[0].dtype, device=parts[0].device)
+        else:
+            x = self._get_workspace(shape, parts[0])
+        # Writes the concatenation of the parts transposed to (num_nodes, total_arg_size, batch_size)
+        x0 = x[0].view(self._num_nodes, input_size, batch_size)
+        offset = 0
+        for part in parts:
+            x0[:, offset: offset + part.size(2)].copy_(part.permute(1, 2, 0))
+            offset += part.size(2)
+        x0 = x[0]
+        order = 1
+        if self._rounds is not None:
+            for lo, hi, x_in, ops in self._rounds:
+                support = self._stacked_supports[(lo, hi)]
+                if len(ops) == 1 and ops[0][1] is not None:
+                    out, prev = ops[0]
+                    torch.addmm(x[prev], support, x[x_in], beta=-1, alpha=2, out=x[out])
+                    continue
+                # The orders of a round are consecutive slices of the stack
+                torch.mm(support, x[x_in], out=x[ops[0][0]: ops[-1][0] + 1].view(-1, x.size(2)))
+                for out, prev in ops:
+                    if prev is not None:
+                        x[out].mul_(2).sub_(x[prev])
+        elif self._max_diffusion_step > 0:
+            for support in self._supports:
+                x1 = torch.mm(support, x0, out=x[order])
+                order += 1
+                for k in range(2, self._max_diffusion_step + 1):
+                    # x2 = 2 * support @ x1 - x0
+                    x2 = torch.addmm(x0, support, x1, beta=-1, alpha=2, out=x[order])
+                    order += 1
+                    x1, x0 = x2, x1
+        return x
+
     def _gconv(self, inputs, state, output_size, bias_start=0.0):
         # Reshape input and state to (batch_size, num_nodes, input_dim/state_dim)
         batch_size = inputs.shape[0]
         inputs = torch.reshape(inputs, (batch_size, self._num_nodes, -1))
         state = torch.reshape(state, (batch_size, self._num_nodes, -1))
-        inputs_and_state = torch.cat([inputs, state], dim=2)
-        input_size = inputs_and_state.size(2)
-
-        x = inputs_and_state
-        x0 = x.permute(1, 2, 0)  # (num_nodes, total_arg_size, batch_size)
-        x0 = torch.reshape(x0, shape=[self._num_nodes, input_size * batch_size])
-        x = torch.unsqueeze(x0, 0)
+        input_size = inputs.size(2) + state.size(2)
 
-        if self._max_diffusion_step == 0:
-            pass
-        else:
-            for support in self._supports:
-                x1 = torch.sparse.mm(support, x0)
-                x = self._concat(x, x1)
+        x = self._flatten_stack(self._diffusion_stack(inputs, state), input_size, batch_size)
+        num_matrices = x.size(1) // input_size
 
-                for k in range(2, self._max_diffusion_step + 1):
-                    x2 = 2 * torch.sparse.mm(support, x1) - x0
-                    x = self._concat(x, x2)
-                    x1, x0 = x2, x1
+        weights = self._gconv_params.get_weights((input_size * num_matrices, output_size))
+        biases = self._gconv_params.get_biases(output_size, bias_start)
+        x = torch.addmm(biases, x, weights)  # (batch_size * self._num_nodes, output_size)
+        # Reshape res back to 2D: (batch_size, num_node, state_dim) -> (batch_size, num_node * state_dim)
+        return torch.reshape(x, [batch_size, self._num_nodes * output_size])
 
-        num_matrices = len(self._supports) * self._max_diffusion_step + 1  # Adds for x itself.
+    def _flatten_stack(self, x, input_size, batch_size):
+        """:return: (batch_size * num_nodes, input_size * num_matrices), the layout the gconv weights expect"""
+        num_matrices = x.size(0)
         x = torch.reshape(x, shape=[num_matrices, self._num_nodes, input_size, batch_size])
         x = x.permute(3, 1, 2, 0)  # (batch_size, num_nodes, input_size, order)
-        x = torch.reshape(x, shape=[batch_size * self._num_nodes, input_size * num_matrices])
+        # Copies out of the workspace, which is overwritten by the next call
+        return torch.reshape(x, shape=[batch_size * self._num_nodes, input_size * num_matrices])
 
-        weights = self._gconv_params.get_weights((input_size * num_matrices, output_size))
-        x = torch.matmul(x, weights)  # (batch_size * self._num_nodes, output_size)
+    def project_inputs(self, inputs):
+        """
+        Input half of the gates and candidate graph convolutions, including the biases. The rows of the
+        gconv weights are ordered (feature, diffusion order), so the first input_dim * num_matrices rows
+        belong to the inputs. Diffusion acts on every column separately, so any number of timesteps can
+        be stacked into the batch and diffused at once.
+        :param inputs: (..., batch_size, num_nodes * input_dim)
+        :return: gates (..., batch_size * num_nodes, 2 * num_units),
+                 candidate (..., batch_size * num_nodes, num_units)
+        """
+        lead_shape = inputs.shape[:-1]
+        batch_size = int(np.prod(lead_shape))
+        inputs = torch.reshape(inputs, (batch_size, self._num_nodes, -1))
+        input_dim = self._input_dim = inputs.size(2)
+        input_size = input_dim + self._num_units
+        x = self._flatten_stack(self._diffusion_stack(inputs), input_dim, batch_size)
+        num_matrices = x.size(1) // input_dim
 
-        biases = self._gconv_params.get_biases(output_size, bias_start)
-        x += biases
-        # Reshape res back to 2D: (batch_size, num_node, state_dim) -> (batch_size, num_node * state_dim)
+        projections = []
+        for output_size, bias_start in [(2 * self._num_units, 1.0), (self._num_units, 0.0)]:
+            weights = self._gconv_params.get_weights((input_size * num_matrices, output_size))
+            biases = self._gconv_params.get_biases(output_size, bias_start)
+            projection = torch.addmm(biases, x, weights[:input_dim * num_matrices])
+            projections.append(torch.reshape(projection, lead_shape[:-1] + (-1, output_size)))
+        return tuple(projections)
+
+    def _gconv_state(self, state, input_projection, output_size):
+        """
+        Graph convolution of [inputs, state] with the input half given by project_inputs.
+        :param state: (batch_size, num_nodes * num_units)
+        :param input_projection: (batch_size * num_nodes, output_size)
+        """
+        batch_size = state.shape[0]
+        state = torch.reshape(state, (batch_size, self._num_nodes, -1))
+        x = self._flatten_stack(self._diffusion_stack(state), self._num_units, batch_size)
+        num_matrices = x.size(1) // self._num_units
+        input_size = self._input_dim + self._num_units
+        weights = self._gconv_params.get_weights((input_size * num_matrices, output_size))
+        x = torch.addmm(input_projection, x, weights[self._input_dim * num_matrices:])
         return torch.reshape(x, [batch_size, self._num_nodes * output_size])
@@ -0,0 +1,180 @@
+from typing import List, Optional
+
+import torch
+import torch.nn as nn
+
+
+class Support(nn.Module):
+    def __init__(self, matrix):
+        super().__init__()
+        self.register_buffer('matrix', matrix)
+
+
+def _select(params, output_size, name):
+    """
+    :param params: LayerParams dict of weights or biases
+    :return: the only parameter with output_size outputs (last dimension)
+    """
+    matches = [param for param in params.values() if param.size(-1) == output_size]
+    if len(matches) != 1:
+        raise ValueError('Expected one {} with {} outputs, found {}'.format(name, output_size, len(matches)))
+    return matches[0]
+
+
+class InferenceDCGRUCell(nn.Module):
+    def __init__(self, cell):
+        """
+        Scriptable copy of a trained DCGRUCell, the supports are buffers and the weights are plain parameters.
+        :param cell: DCGRUCell with registered parameters
+        """
+        super().__init__()
+        self.num_nodes = cell._num_nodes
+        self.num_units = cell._num_units
+        self.max_diffusion_step = cell._max_diffusion_step
+        self.use_gc_for_ru = cell._use_gc_for_ru
+        self.relu = cell._activation is torch.relu
+        self.supports = nn.ModuleList([Support(support) for support in cell._supports])
+
+        # The gates have 2 * num_units outputs, the candidate num_units, whatever order they were created in
+        gate_params = cell._gconv_params if self.use_gc_for_ru else cell._fc_params
+        gate_weight = _select(gate_params._params_dict, 2 * self.num_units, 'gate weight')
+        gate_bias = _select(gate_params._biases_dict, 2 * self.num_units, 'gate bias')
+        candidate_weight = _select(cell._gconv_params._params_dict, self.num_units, 'candidate weight')
+        candidate_bias = _select(cell._gconv_params._biases_dict, self.num_units, 'candidate bias')
+        self.gate_weight = nn.Parameter(gate_weight.detach().clone(), requires_grad=False)
+        self.gate_bias = nn.Parameter(gate_bias.detach().clone(), requires_grad=False)
+        self.candidate_weight = nn.Parameter(candidate_weight.detach().clone(), requires_grad=False)
+        self.candidate_bias = nn.Parameter(candidate_bias.detach().clone(), requires_grad=False)
+
+    def _gconv(self, inputs, state, weight, bias):
+        batch_size = inputs.size(0)
+        inputs = torch.reshape(inputs, (batch_size, self.num_nodes, -1))
+        state = torch.reshape(state, (batch_size, self.num_nodes, -1))
+        input_size = inputs.size(2) + state.size(2)
+        num_matrices = len(self.supports) * self.max_diffusion_step + 1
+
+        # Diffusion orders are written into one preallocated stack, as in DCGRUCell._diffusion_stack
+        x = torch.empty((num_matrices, self.num_nodes, input_size * batch_size),
+                        dtype=inputs.dtype, device=inputs.device)
+        x[0].view(self.num_nodes, input_size, batch_size).copy_(torch.cat([inputs, state], dim=2).permute(1, 2, 0))
+        x0 = x[0]
+        order = 1
+        if self.max_diffusion_step > 0:
+            for support in self.supports:
+                x1 = torch.mm(support.matrix, x0, out=x[order])
+                order += 1
+                for k in range(2, self.max_diffusion_step + 1):
+                    x2 = torch.addmm(x0, support.matrix, x1, beta=-1., alpha=2., out=x[order])
+                    order += 1
+                    x1, x0 = x2, x1
+        x = torch.reshape(x, (num_matrices, self.num_nodes, input_size, batch_size))
+        x = torch.reshape(x.permute(3, 1, 2, 0), (batch_size * self.num_nodes, input_size * num_matrices))
+        return torch.addmm(bias, x, weight)
+
+    def _fc(self, inputs, state):
+        batch_size = inputs.size(0)
+        inputs = torch.reshape(inputs, (batch_size * self.num_nodes, -1))
+        state = torch.reshape(state, (batch_size * self.num_nodes, -1))
+        return torch.sigmoid(torch.mm(torch.cat([inputs, state], dim=-1), self.gate_weight)) + self.gate_bias
+
+    def forward(self, inputs, hx):
+        """
+        :param inputs: (B, num_nodes * input_dim)
+        :param hx: (B, num_nodes * rnn_units)
+        :return: (B, num_nodes * rnn_units)
+        """
+        batch_size = inputs.size(0)
+        if self.use_gc_for_ru:
+            value = self._gconv(inputs, hx, self.gate_weight, self.gate_bias)
+        else:
+            value = self._fc(inputs, hx)
+        value = torch.reshape(torch.sigmoid(value), (batch_size, self.num_nodes, 2 * self.num_units))
+        r, u = torch.split(value, self.num_units, dim=-1)
+        r = torch.reshape(r, (batch_size, self.num_nodes * self.num_units))
+        u = torch.reshape(u, (batch_size, self.num_nodes * self.num_units))
+
+        c = self._gconv(inputs, r * hx, self.candidate_weight, self.candidate_bias)
+        c = torch.reshape(c, (batch_size, self.num_nodes * self.num_units))
+        c = torch.relu(c) if self.relu else torch.tanh(c)
+        return u * hx + (1.0 - u) * c
+
+
+class DCRNNInference(nn.Module):
+    def __init__(self, model):
+        """
+        Inference-only DCRNN: no curriculum learning, logging or lazy parameters, so it can be compiled
+        with torch.jit.script and served without the training code.
+        :param model: trained DCRNNModel
+        """
+        super().__init__()
+        self.num_nodes = model.num_nodes
+        self.rnn_units = model.rnn_units
+        self.num_rnn_layers = model.num_rnn_layers
+        self.seq_len = model.encoder_model.seq_len
+        self.horizon = model.decoder_model.horizon
+        self.output_dim = model.decoder_model.output_dim
+        self.encoder_cells = nn.ModuleList([InferenceDCGRUCell(cell) for cell in model.encoder_model.dcgru_layers])
+        self.decoder_cells = nn.ModuleList([InferenceDCGRUCell(cell) for cell in model.decoder_model.dcgru_layers])
+        self.projection_layer = nn.Linear(self.rnn_units, self.output_dim)
+        self.projection_layer.load_state_dict(model.decoder_model.projection_layer.state_dict())
+        self.requires_grad_(False)
+
+    def encode(self, inputs, hidden_state: Optional[torch.Tensor] = None):
+        """
+        :param inputs: (seq_len, batch_size, num_nodes * input_dim)
+        :param hidden_state: (num_layers, batch_size, num_nodes * rnn_units), zeros if not given
+        :return: (num_layers, batch_size, num_nodes * rnn_units)
+        """
+        if hidden_state is None:
+            hidden_state = torch.zeros((self.num_rnn_layers, inputs.size(1), self.num_nodes * self.rnn_units),
+                                       dtype=inputs.dtype, device=inputs.device)
+        states = hidden_state.unbind(0)
+        for t in range(inputs.size(0)):
+            output = inputs[t]
+            next_states: List[torch.Tensor] = []
+            for layer_num, cell in enumerate(self.encoder_cells):
+                output = cell(output, states[layer_num])
+                next_states.append(output)
+            states = next_states
+        return torch.stack(states)
+
+    def decode(self, hidden_state):
+        """
+        :param hidden_state: (num_layers, batch_size, num_nodes * rnn_units)
+        :return: (horizon, batch_size, num_nodes * output_dim)
+        """
+        batch_size = hidden_state.size(1)
+        decoder_input = torch.zeros((batch_size, self.num_nodes * self.output_dim),
+                                    dtype=hidden_state.dtype, device=hidden_state.device)
+        states = hidden_state.unbind(0)
+        outputs: List[torch.Tensor] = []
+        for t in range(self.horizon):
+            output = decoder_input
+            next_states: List[torch.Tensor] = []
+            for layer_num, cell in enumerate(self.decoder_cells):
+                output = cell(output, states[layer_num])
+                next_states.append(output)
+            states = next_states
+            projected = self.projection_layer(output.view(-1, self.rnn_units))
+            decoder_input = projected.view(batch_size, self.num_nodes * self.output_dim)
+            outputs.append(decoder_input)
+        return torch.stack(outputs)
+
+    def forward(self, inputs):
+        """
+        :param inputs: (seq_len, batch_size, num_nodes * input_dim)
+        :return: (horizon, batch_size, num_nodes * output_dim)
+        """
+        return self.decode(self.encode(inputs))
+
+
+def export(model, path=None):
+    """
+    Scripts the inference path of a DCRNNModel, saved to path if given.
+    Load it with torch.jit.load(path), only torch is needed.
+    :return: the ScriptModule
+    """
+    scripted = torch.jit.script(DCRNNInference(model).eval())
+    if path is not None:
+        torch.jit.save(scripted, path)
+    return scripted
@@ -16,6 +16,9 @@ class Seq2SeqAttrs:
         self.max_diffusion_step = int(model_kwargs.get('max_diffusion_step', 2))
         self.cl_decay_steps = int(model_kwargs.get('cl_decay_steps', 1000))
         self.filter_type = model_kwargs.get('filter_type', 'laplacian')
+        self.sparse_format = model_kwargs.get('sparse_format', 'coo')
+        self.stack_supports = bool(model_kwargs.get('stack_supports', False))
+        self.reuse_input_diffusion = bool(model_kwargs.get('reuse_input_diffusion', False))
         self.num_nodes = int(model_kwargs.get('num_nodes', 1))
         self.num_rnn_layers = int(model_kwargs.get('num_rnn_layers', 1))
         self.rnn_units = int(model_kwargs.get('rnn_units'))
@@ -30,15 +33,19 @@ class EncoderModel(nn.Module, Seq2SeqAttrs):
         self.seq_len = int(model_kwargs.get('seq_len'))  # for the encoder
         self.dcgru_layers = nn.ModuleList(
             [DCGRUCell(self.rnn_units, supports, self.max_diffusion_step, self.num_nodes,
-                       filter_type=self.filter_type) for _ in range(self.num_rnn_layers)])
+                       filter_type=self.filter_type, sparse_format=self.sparse_format,
+                       stack_supports=self.stack_supports, reuse_input_diffusion=self.reuse_input_diffusion,
+                       input_dim=self.input_dim if i == 0 else self.rnn_units)
+             for i in range(self.num_rnn_layers)])
 
-    def forward(self, inputs, hidden_state=None):
+    def forward(self, inputs, hidden_state=None, input_projection=None):
         """
         Encoder forward pass.
 
         :param inputs: shape (batch_size, self.num_nodes * self.input_dim)
         :param hidden_state: (num_layers, batch_size, self.hidden_state_size)
                optional, zeros if not provided
+        :param input_projection: dcgru_layers[0].project_inputs(inputs), optional
         :return: output: # shape (batch_size, self.hidden_state_size)
                  hidden_state # shape (num_layers, batch_size, self.hidden_state_size)
                  (lower indices mean lower layers)
@@ -50,7 +57,8 @@ class EncoderModel(nn.Module, Seq2SeqAttrs):
         hidden_states = []
         output = inputs
         for layer_num, dcgru_layer in enumerate(self.dcgru_layers):
-            next_hidden_state = dcgru_layer(output, hidden_state[layer_num])
+            next_hidden_state = dcgru_layer(output, hidden_state[layer_num],
+                                            input_projection if layer_num == 0 else None)
             hidden_states.append(next_hidden_state)
             output = next_hidden_state
 
@@ -67,7 +75,10 @@ class DecoderModel(nn.Module, Seq2SeqAttrs):
         self.projection_layer = nn.Linear(self.rnn_units, self.output_dim)
         self.dcgru_layers = nn.ModuleList(
             [DCGRUCell(self.rnn_units, supports, self.max_diffusion_step, self.num_nodes,
-                       filter_type=self.filter_type) for _ in range(self.num_rnn_layers)])
+                       filter_type=self.filter_type, sparse_format=self.sparse_format,
+                       stack_supports=self.stack_supports, reuse_input_diffusion=self.reuse_input_diffusion,
+                       input_dim=self.output_dim if i == 0 else self.rnn_units)
+             for i in range(self.num_rnn_layers)])
 
     def forward(self, inputs, hidden_state=None):
         """
@@ -101,20 +112,32 @@ class DCRNNModel(nn.Module, Seq2SeqAttrs):
         self.decoder_model = DecoderModel(supports, **model_kwargs)
         self.cl_decay_steps = int(model_kwargs.get('cl_decay_steps', 1000))
         self.use_curriculum_learning = bool(model_kwargs.get('use_curriculum_learning', False))
+        # Teacher forcing decided per sample instead of once per batch
+        self.curriculum_per_sample = bool(model_kwargs.get('curriculum_per_sample', False))
         self._logger = logger
 
     def _compute_sampling_threshold(self, batches_seen):
         return self.cl_decay_steps / (
                 self.cl_decay_steps + np.exp(batches_seen / self.cl_decay_steps))
 
-    def encoder(self, inputs):
+    def encoder(self, inputs, encoder_hidden_state=None):
         """
         encoder forward pass on t time steps
-        :param inputs: shape (seq_len, batch_size, num_sensor * input_dim)
+        :param inputs: shape (t, batch_size, num_sensor * input_dim), t is seq_len for a full window
+        :param encoder_hidden_state: state to continue from, (num_layers, batch_size, self.hidden_state_size)
+               optional, zeros if not provided
         :return: encoder_hidden_state: (num_layers, batch_size, self.hidden_state_size)
         """
-        encoder_hidden_state = None
-        for t in range(self.encoder_model.seq_len):
+        num_steps = inputs.size(0)
+        if self.reuse_input_diffusion:
+            # The inputs of the first layer do not depend on the state, diffuse all timesteps at once
+            # so that only the state is diffused in the time loop
+            gates, candidate = self.encoder_model.dcgru_layers[0].project_inputs(inputs)
+            for t in range(num_steps):
+                _, encoder_hidden_state = self.encoder_model(inputs[t], encoder_hidden_state, (gates[t], candidate[t]))
+            return encoder_hidden_state
+
+        for t in range(num_steps):
             _, encoder_hidden_state = self.encoder_model(inputs[t], encoder_hidden_state)
 
         return encoder_hidden_state
@@ -133,6 +156,13 @@ class DCRNNModel(nn.Module, Seq2SeqAttrs):
         decoder_hidden_state = encoder_hidden_state
         decoder_input = go_symbol
 
+        teacher_forcing = None
+        if self.training and self.use_curriculum_learning:
+            # Drawn for all steps at once on the device, True feeds the label instead of the prediction
+            shape = (self.decoder_model.horizon, batch_size if self.curriculum_per_sample else 1, 1)
+            teacher_forcing = (torch.rand(shape, device=encoder_hidden_state.device)
+                               < self._compute_sampling_threshold(batches_seen))
+
         outputs = []
 
         for t in range(self.decoder_model.horizon):
@@ -140,10 +170,8 @@ class DCRNNModel(nn.Module, Seq2SeqAttrs):
                                                                       decoder_hidden_state)
             decoder_input = decoder_output
             outputs.append(decoder_output)
-            if self.training and self.use_curriculum_learning:
-                c = np.random.uniform(0, 1)
-                if c < self._compute_sampling_threshold(batches_seen):
-                    decoder_input = labels[t]
+            if teacher_forcing is not None:
+                decoder_input = torch.where(teacher_forcing[t], labels[t], decoder_output)
         outputs = torch.stack(outputs)
         return outputs
 
@@ -0,0 +1,127 @@
+import collections
+import logging
+
+import numpy as np
+import torch
+
+from lib.dataloaders.dataloader import EnrichedSeries, StandardScaler
+from model.pytorch.dcrnn_export import export
+from model.pytorch.dcrnn_model import DCRNNModel
+
+device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+
+class DCRNNPredictor:
+    def __init__(self, adj_mx, checkpoint_file, scaler_file=None, script=False, resync_every=None):
+        """
+        Online forecasts from a trained DCRNN. Unlike DCRNNSupervisor nothing but the checkpoint and
+        the scaler is read: no dataset, metrics, log dir or TensorBoard writer.
+        :param adj_mx: supports of the model, as given to DCRNNSupervisor
+        :param checkpoint_file: saved by DCRNNSupervisor.save_model, holds the config and the weights
+        :param scaler_file: defaults to <dataset_file>.scaler.npz of the data config
+        :param script: run the TorchScript inference model instead of the eager DCRNNModel
+        :param resync_every: step re-encodes the last seq_len frames from a zero state every resync_every
+               frames, None advances the state indefinitely
+        """
+        checkpoint = torch.load(checkpoint_file, map_location='cpu')
+        self._model_kwargs = checkpoint['model']
+        self._logger = logging.getLogger(__name__)
+        if scaler_file is None:
+            scaler_file = checkpoint['data']['dataset_file'] + '.scaler.npz'
+        self.standard_scaler = StandardScaler.load(scaler_file)
+
+        self.num_nodes = int(self._model_kwargs.get('num_nodes', 1))
+        self.input_dim = int(self._model_kwargs.get('input_dim', 1))
+        self.seq_len = int(self._model_kwargs.get('seq_len'))
+        self.output_dim = int(self._model_kwargs.get('output_dim', 1))
+        self.horizon = int(self._model_kwargs.get('horizon', 1))
+
+        dcrnn_model = DCRNNModel(adj_mx, self._logger, **self._model_kwargs)
+        dcrnn_model.load_state_dict(checkpoint['model_state_dict'])
+        self.dcrnn_model = dcrnn_model.to(device).eval()
+        if script:
+            scripted = export(self.dcrnn_model)
+            self._encode, self._decode = scripted.encode, scripted.decode
+        else:
+            self._encode, self._decode = self.dcrnn_model.encoder, self.dcrnn_model.decoder
+
+        self.resync_every = resync_every
+        self.reset()
+
+    def _enrich(self, window, timestamps):
+        """
+        :param window: (..., seq_len, num_nodes) readings
+        :param timestamps: (..., seq_len) datetime64, required for the time features when input_dim > 1
+        :return: (..., seq_len, num_nodes, input_dim) with the readings standardised
+        """
+        if self.input_dim == 1:
+            x = window[..., None]
+        else:
+            assert timestamps is not None, 'The model expects time features, timestamps are required'
+            series = EnrichedSeries(window.reshape(-1, self.num_nodes), np.asarray(timestamps).reshape(-1),
+                                    add_time_in_day=True, add_day_in_week=self.input_dim > 2)
+            x = series[:].reshape(window.shape + (self.input_dim,))
+        x = np.array(x, dtype=np.float32)
+        x[..., 0] = self.standard_scaler.transform(x[..., 0])
+        return x
+
+    def predict(self, window, timestamps=None):
+        """
+        Forecasts the next horizon frames from the last seq_len frames.
+        :param window: (seq_len, num_nodes) raw readings, or (batch_size, seq_len, num_nodes) for several windows
+        :param timestamps: (seq_len,) or (batch_size, seq_len) datetime64 of the frames of the window
+        :return: (horizon, num_nodes, output_dim) de-scaled forecasts, (batch_size, horizon, ...) for a batch
+        """
+        window = np.asarray(window, dtype=np.float32)
+        single = window.ndim == 2
+        if single:
+            window = window[None]
+            timestamps = None if timestamps is None else np.asarray(timestamps)[None]
+        assert window.shape[1:] == (self.seq_len, self.num_nodes), 'Expected windows of (seq_len, num_nodes)'
+        batch_size = window.shape[0]
+
+        x = torch.from_numpy(self._enrich(window, timestamps)).to(device)
+        x = x.permute(1, 0, 2, 3).reshape(self.seq_len, batch_size, self.num_nodes * self.input_dim)
+        with torch.no_grad():
+            outputs = self._decode(self._encode(x))
+        outputs = self._descale(outputs, batch_size)
+        return outputs[0] if single else outputs
+
+    def _descale(self, outputs, batch_size):
+        """:return: (batch_size, horizon, num_nodes, output_dim)"""
+        outputs = self.standard_scaler.inverse_transform(outputs)
+        outputs = outputs.view(self.horizon, batch_size, self.num_nodes, self.output_dim).permute(1, 0, 2, 3)
+        return outputs.cpu().numpy()
+
+    def reset(self):
+        """Forgets the frames and the encoder state of step, e.g. after a gap in the stream."""
+        self._frames = collections.deque(maxlen=self.seq_len)
+        self._hidden_state = None
+        self._steps_since_sync = 0
+
+    def step(self, frame, timestamp=None):
+        """
+        Streaming forecast: the encoder state is advanced by a single DCGRU step for the new frame and
+        only the decoder runs. Unlike predict, the state also carries the frames before the window,
+        resync_every bounds how far it drifts from the state of the window alone.
+        :param frame: (num_nodes,) raw readings of the newest timestep
+        :param timestamp: datetime64 of the frame, required for the time features when input_dim > 1
+        :return: (horizon, num_nodes, output_dim) de-scaled forecasts, None until seq_len frames were seen
+        """
+        frame = np.asarray(frame, dtype=np.float32).reshape(1, self.num_nodes)
+        timestamps = None if timestamp is None else np.asarray([timestamp])
+        x = torch.from_numpy(self._enrich(frame, timestamps)).to(device)
+        x = x.reshape(1, 1, self.num_nodes * self.input_dim)
+        self._frames.append(x)
+        if len(self._frames) < self.seq_len:
+            return None
+
+        self._steps_since_sync += 1
+        with torch.no_grad():
+            if self._hidden_state is None or (self.resync_every and self._steps_since_sync >= self.resync_every):
+                self._hidden_state = self._encode(torch.cat(list(self._frames)))
+                self._steps_since_sync = 0
+            else:
+                self._hidden_state = self._encode(x, self._hidden_state)
+            outputs = self._decode(self._hidden_state)
+        return self._descale(outputs, 1)[0]
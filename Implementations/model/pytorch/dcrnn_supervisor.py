@@ -6,10 +6,12 @@ import torch
 from torch.utils.tensorboard import SummaryWriter
 
 from lib import utils
+from lib.dataloaders.prefetcher import Prefetcher
 from lib.logger import get_logger
 from lib.metrics import metrics_np
 
 from lib.metrics.metrics_torch import masked_mae_torch
+from model.pytorch.dcrnn_export import export
 from model.pytorch.dcrnn_model import DCRNNModel
 from tqdm import tqdm
 
@@ -36,6 +38,8 @@ class DCRNNSupervisor:
         self.ds = utils.load_dataset(**self._data_kwargs)
         self._data = self.ds.data
         self.standard_scaler = self._data['scaler']
+        # Number of batches prepared in a background thread, 0 disables prefetching
+        self.num_prefetch = int(self._data_kwargs.get('prefetch', 0))
 
         self.num_nodes = int(self._model_kwargs.get('num_nodes', 1))
         self.input_dim = int(self._model_kwargs.get('input_dim', 1))
@@ -96,22 +100,15 @@ class DCRNNSupervisor:
         return 'data/metr-la/checkpoints/dcrnn_pytorch_%d.tar' % epoch
 
     def load_model(self):
-        self._setup_graph()
         assert os.path.exists('data/metr-la/checkpoints/dcrnn_pytorch_%d.tar' % self._epoch_num), 'Weights at epoch %d not found' % self._epoch_num
         checkpoint = torch.load('data/metr-la/checkpoints/dcrnn_pytorch_%d.tar' % self._epoch_num, map_location='cpu')
         self.dcrnn_model.load_state_dict(checkpoint['model_state_dict'])
         self._logger.info("Loaded model at {}".format(self._epoch_num))
 
-    def _setup_graph(self):
-        with torch.no_grad():
-            self.dcrnn_model = self.dcrnn_model.eval()
-
-            val_iterator = self._data['val_loader'].get_iterator()
-
-            for _, (x, y) in enumerate(val_iterator):
-                x, y = self._prepare_data(x, y)
-                output = self.dcrnn_model(x)
-                break
+    def export_model(self, path):
+        """Saves the TorchScript inference model, loadable with torch.jit.load(path) alone."""
+        export(self.dcrnn_model, path)
+        self._logger.info("Exported inference model to {}".format(path))
 
     def train(self, **kwargs):
         kwargs.update(self._train_kwargs)
@@ -124,12 +121,11 @@ class DCRNNSupervisor:
         """
         with torch.no_grad():
             self.dcrnn_model = self.dcrnn_model.eval()
-            val_iterator = self._data['{}_loader'.format(dataset)].get_iterator()
+            val_iterator = self._get_batches(dataset)
             losses = []
             y_truths = []
             y_preds = []
             for i, (x, y) in tqdm(enumerate(val_iterator)):
-                x, y = self._prepare_data(x, y)
                 output = self.dcrnn_model(x)
                 loss = self._compute_loss(y, output)
                 losses.append(loss.item())
@@ -167,7 +163,7 @@ class DCRNNSupervisor:
 
     def _train(self, base_lr,
                steps, patience=50, epochs=100, lr_decay_ratio=0.1, log_every=1, save_model=1,
-               test_every_n_epochs=10, epsilon=1e-8, **kwargs):
+               test_every_n_epochs=10, epsilon=1e-8, precision='float32', **kwargs):
         # steps is used in learning rate - will see if need to use it?
         print('Train with args:', base_lr,
                steps, patience, epochs, lr_decay_ratio, log_every, save_model,
@@ -179,6 +175,14 @@ class DCRNNSupervisor:
         lr_scheduler = torch.optim.lr_scheduler.MultiStepLR(optimizer, milestones=steps,
                                                             gamma=lr_decay_ratio)
 
+        # Mixed precision: autocast runs the dense matmuls of the DCGRU cells and the projection layer in
+        # bfloat16/float16, the sparse diffusion stays in float32. Only bfloat16/float16 use the torch.amp
+        # API (torch >= 2.3), float32 training runs on any supported torch.
+        amp_dtype = {'float32': None, 'bfloat16': torch.bfloat16, 'float16': torch.float16}[precision]
+        # float16 gradients underflow without loss scaling, bfloat16 has the range of float32
+        grad_scaler = torch.amp.GradScaler(device.type) if amp_dtype == torch.float16 else None
+        self._logger.info('Training precision: {}'.format(precision))
+
         self._logger.info('Start training ...')
 
         # this will fail if model is loaded with a changed batch_size
@@ -191,7 +195,7 @@ class DCRNNSupervisor:
 
             self.dcrnn_model = self.dcrnn_model.train()
 
-            train_iterator = self._data['train_loader'].get_iterator()
+            train_iterator = self._get_batches('train')
             losses = []
 
             start_time = time.time()
@@ -199,28 +203,37 @@ class DCRNNSupervisor:
             for _, (x, y) in tqdm(enumerate(train_iterator)):
                 optimizer.zero_grad()
 
-                x, y = self._prepare_data(x, y)
+                if amp_dtype is None:
+                    output = self.dcrnn_model(x, y, batches_seen)
+                else:
+                    with torch.autocast(device.type, dtype=amp_dtype):
+                        output = self.dcrnn_model(x, y, batches_seen)
 
-                output = self.dcrnn_model(x, y, batches_seen)
-
-                if batches_seen == 0:
-                    # this is a workaround to accommodate dynamically registered parameters in DCGRUCell
-                    optimizer = torch.optim.Adam(self.dcrnn_model.parameters(), lr=base_lr, eps=epsilon)
-
-                loss = self._compute_loss(y, output)
+                loss = self._compute_loss(y, output.float())
 
                 self._logger.debug(loss.item())
 
                 losses.append(loss.item())
 
                 batches_seen += 1
-                loss.backward()
+                if grad_scaler is None:
+                    loss.backward()
+                else:
+                    grad_scaler.scale(loss).backward()
+                    grad_scaler.unscale_(optimizer)
 
                 # gradient clipping - this does it in place
                 torch.nn.utils.clip_grad_norm_(self.dcrnn_model.parameters(), self.max_grad_norm)
 
-                optimizer.step()
+                if grad_scaler is None:
+                    optimizer.step()
+                else:
+                    grad_scaler.step(optimizer)
+                    grad_scaler.update()
             self._logger.info("epoch complete")
+            if isinstance(train_iterator, Prefetcher):
+                self._logger.info("prefetching saved {:.1f}s, waited {:.1f}s for data".format(
+                    train_iterator.saved_time, train_iterator.wait_time))
             lr_scheduler.step()
             self._logger.info("evaluating now!")
 
@@ -262,6 +275,21 @@ class DCRNNSupervisor:
                     self._logger.warning('Early stopping at epoch: %d' % epoch_num)
                     break
 
+    def _get_batches(self, dataset):
+        """
+        Yields batches from the dataset loader, ready for the model.
+        With data.prefetch > 0 they are prepared in a worker thread.
+        """
+        iterator = self._data['{}_loader'.format(dataset)].get_iterator()
+        if self.num_prefetch > 0:
+            return Prefetcher(iterator, self._prepare_host_data, self.num_prefetch, device=device)
+        return (self._prepare_data(x, y) for x, y in iterator)
+
+    def _prepare_host_data(self, x, y):
+        x, y = self._get_x_y(x, y)
+        x, y = self._get_x_y_in_correct_dims(x, y)
+        return x.contiguous(), y.contiguous()
+
     def _prepare_data(self, x, y):
         x, y = self._get_x_y(x, y)
         x, y = self._get_x_y_in_correct_dims(x, y)
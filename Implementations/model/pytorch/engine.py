@@ -3,24 +3,36 @@ import torch.optim as optim
 from torch import nn
 from tqdm import tqdm
 
+from lib.dataloaders.prefetcher import Prefetcher
 from lib.metrics import metrics_torch
 from model.pytorch.gwnet_model import gwnet
 
 class Evaluator():
-    def __init__(self, scaler, device, model):
+    def __init__(self, scaler, device, model, num_prefetch=0):
         self.model = model
         self.model.to(device)
         self.scaler = scaler
         self.device = device
+        self.num_prefetch = num_prefetch
+
+    @staticmethod
+    def _prepare_host_data(x, y):
+        testx = torch.Tensor(x).transpose(1, 3).contiguous()
+        testy = torch.Tensor(y[..., 0])
+        return testx, testy
+
+    def _get_batches(self, loader):
+        iterator = loader.get_iterator()
+        if self.num_prefetch > 0:
+            return Prefetcher(iterator, self._prepare_host_data, self.num_prefetch, device=self.device)
+        return ((torch.Tensor(x).to(self.device).transpose(1, 3), torch.Tensor(y[..., 0]).to(self.device))
+                for x, y in iterator)
 
     def compute_preds(self, loader):
         self.model.eval()
         outputs = []
         y_vals = []
-        for iter, (x, y) in tqdm(enumerate(loader.get_iterator())):
-            testx = torch.Tensor(x).to(self.device)
-            testy = torch.Tensor(y[..., 0]).to(self.device)
-            testx = testx.transpose(1, 3)
+        for iter, (testx, testy) in tqdm(enumerate(self._get_batches(loader))):
             with torch.no_grad():
                 # [64, 12, 1, 207]
                 output = self.model(testx)
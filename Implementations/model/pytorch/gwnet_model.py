@@ -5,11 +5,44 @@ from torch.autograd import Variable
 import sys
 
 
+def sparse_support(A):
+    """
+    CSR operator of a dense support for nconv. nconv contracts over the rows of A, so the transpose is
+    stored and applied with a single SpMM.
+    """
+    return A.t().contiguous().to_sparse_csr()
+
+
+def topk_adaptive_adj(nodevec1, nodevec2, k, chunk_size=1024):
+    """
+    softmax(relu(nodevec1 @ nodevec2)) over the k largest entries of every row, as a sparse_support.
+    The N x N scores only exist chunk_size rows at a time to select the neighbours, the kept scores
+    are recomputed from the node embeddings so the gradient flows through them.
+    """
+    num_nodes = nodevec1.size(0)
+    k = min(k, num_nodes)
+    with torch.no_grad():
+        cols = torch.cat([torch.topk(torch.mm(nodevec1[i:i + chunk_size], nodevec2), k, dim=1).indices
+                          for i in range(0, num_nodes, chunk_size)])
+    rows = torch.arange(num_nodes, device=cols.device).unsqueeze(1).expand(-1, k)
+    scores = torch.einsum('nd,dnk->nk', nodevec1, nodevec2[:, cols])
+    values = F.softmax(F.relu(scores), dim=1)
+    # Transposed like sparse_support, COO since autograd supports SpMM with its values
+    indices = torch.stack([cols.reshape(-1), rows.reshape(-1)])
+    return torch.sparse_coo_tensor(indices, values.reshape(-1), (num_nodes, num_nodes)).coalesce()
+
+
 class nconv(nn.Module):
     def __init__(self):
         super(nconv,self).__init__()
 
     def forward(self,x, A):
+        if A.layout != torch.strided:
+            # A is a sparse_support, SpMM over the (nodes, batch * channels * time) layout
+            n, c, v, l = x.shape
+            x = torch.mm(A, x.permute(2, 0, 1, 3).reshape(v, n * c * l))
+            # Left as a view, the next nconv reads it back in the SpMM layout without a copy
+            return x.view(-1, n, c, l).permute(1, 2, 0, 3)
         x = torch.einsum('ncvl,vw->ncwl',(x,A))
         return x.contiguous()
 
@@ -21,16 +54,58 @@ class linear(nn.Module):
     def forward(self,x):
         return self.mlp(x)
 
+def stack_supports(supports, order=2):
+    """
+    [I, A_1, .., A_1^order, A_2, ..] concatenated into one (N, (order * len(supports) + 1) * N) operator,
+    so gcn diffuses with all supports and hops in a single matmul. The operator is dense, so are the supports.
+    """
+    powers = []
+    for a in supports:
+        if a.layout != torch.strided:
+            raise ValueError('stack_supports builds a dense operator, got a sparse support')
+        ak = a
+        powers.append(ak)
+        for k in range(2, order + 1):
+            ak = torch.mm(ak, a)
+            powers.append(ak)
+    identity = torch.eye(powers[0].size(0), dtype=powers[0].dtype, device=powers[0].device)
+    return torch.cat([identity] + powers, dim=1)
+
+
+def check_gcn_options(gcn_strategy, sparse_supports=False, adaptive_topk=None):
+    """
+    The stacked strategy multiplies dense powers of the supports, which would densify the CSR supports and
+    the top-k adaptive adjacency on every forward.
+    :raises ValueError: for the stacked strategy with sparse_supports or adaptive_topk
+    """
+    if gcn_strategy == 'stacked' and (sparse_supports or adaptive_topk):
+        raise ValueError('gcn_strategy stacked needs dense supports, it does not combine with '
+                         'sparse_supports or adaptive_topk')
+
+
 class gcn(nn.Module):
-    def __init__(self,c_in,c_out,dropout,support_len=3,order=2):
+    def __init__(self,c_in,c_out,dropout,support_len=3,order=2,strategy='chain'):
+        """
+        :param strategy: 'chain' diffuses hop by hop with every support, 'stacked' applies the
+               stack_supports operator, which forward then expects instead of the supports.
+        """
         super(gcn,self).__init__()
         self.nconv = nconv()
         c_in = (order*support_len+1)*c_in
         self.mlp = linear(c_in,c_out)
         self.dropout = dropout
         self.order = order
+        self.strategy = strategy
 
     def forward(self,x,support):
+        if self.strategy == 'stacked':
+            # (n, c, l, v) @ (v, terms * v), the terms then go to the channels in the order of the chain
+            n, c, v, l = x.shape
+            h = torch.matmul(x.transpose(2, 3), support)
+            h = h.view(n, c, l, -1, v).permute(0, 3, 1, 4, 2).reshape(n, -1, v, l)
+            h = self.mlp(h)
+            return F.dropout(h, self.dropout, training=self.training)
+
         out = [x]
         for a in support:
             x1 = self.nconv(x,a)
@@ -47,13 +122,23 @@ class gcn(nn.Module):
 
 
 class gwnet(nn.Module):
-    def __init__(self, device, num_nodes, dropout=0.3, supports=None, gcn_bool=True, addaptadj=True, aptinit=None, in_dim=2,out_dim=12,residual_channels=32,dilation_channels=32,skip_channels=256,end_channels=512,kernel_size=2,blocks=4,layers=2):
+    def __init__(self, device, num_nodes, dropout=0.3, supports=None, gcn_bool=True, addaptadj=True, aptinit=None, in_dim=2,out_dim=12,residual_channels=32,dilation_channels=32,skip_channels=256,end_channels=512,kernel_size=2,blocks=4,layers=2,sparse_supports=False,adaptive_topk=None,gcn_strategy='chain'):
+        """
+        :param sparse_supports: store the static supports as CSR and diffuse with SpMM, faster for large
+               sparse graphs.
+        :param adaptive_topk: keep the k strongest neighbours per node of the adaptive adjacency, as a sparse
+               support. None keeps the dense N x N matrix.
+        :param gcn_strategy: 'chain' or 'stacked', see gcn. stacked needs dense supports, see check_gcn_options
+        """
+        check_gcn_options(gcn_strategy, sparse_supports, adaptive_topk)
         super(gwnet, self).__init__()
         self.dropout = dropout
         self.blocks = blocks
         self.layers = layers
         self.gcn_bool = gcn_bool
         self.addaptadj = addaptadj
+        self.adaptive_topk = adaptive_topk
+        self.gcn_strategy = gcn_strategy
 
         self.filter_convs = nn.ModuleList()
         self.gate_convs = nn.ModuleList()
@@ -65,6 +150,8 @@ class gwnet(nn.Module):
         self.start_conv = nn.Conv2d(in_channels=in_dim,
                                     out_channels=residual_channels,
                                     kernel_size=(1,1))
+        if supports is not None and sparse_supports:
+            supports = [sparse_support(a) for a in supports]
         self.supports = supports
 
         receptive_field = 1
@@ -102,17 +189,17 @@ class gwnet(nn.Module):
                                                    out_channels=dilation_channels,
                                                    kernel_size=(1,kernel_size),dilation=new_dilation))
 
-                self.gate_convs.append(nn.Conv1d(in_channels=residual_channels,
+                self.gate_convs.append(nn.Conv2d(in_channels=residual_channels,
                                                  out_channels=dilation_channels,
                                                  kernel_size=(1, kernel_size), dilation=new_dilation))
 
                 # 1x1 convolution for residual connection
-                self.residual_convs.append(nn.Conv1d(in_channels=dilation_channels,
+                self.residual_convs.append(nn.Conv2d(in_channels=dilation_channels,
                                                      out_channels=residual_channels,
                                                      kernel_size=(1, 1)))
 
                 # 1x1 convolution for skip connection
-                self.skip_convs.append(nn.Conv1d(in_channels=dilation_channels,
+                self.skip_convs.append(nn.Conv2d(in_channels=dilation_channels,
                                                  out_channels=skip_channels,
                                                  kernel_size=(1, 1)))
                 self.bn.append(nn.BatchNorm2d(residual_channels))
@@ -120,7 +207,8 @@ class gwnet(nn.Module):
                 receptive_field += additional_scope
                 additional_scope *= 2
                 if self.gcn_bool:
-                    self.gconv.append(gcn(dilation_channels,residual_channels,dropout,support_len=self.supports_len))
+                    self.gconv.append(gcn(dilation_channels,residual_channels,dropout,support_len=self.supports_len,
+                                          strategy=gcn_strategy))
 
 
 
@@ -135,10 +223,61 @@ class gwnet(nn.Module):
                                     bias=True)
 
         self.receptive_field = receptive_field
+        # (key, supports derived from the parameters) reused by inference, see _get_supports
+        self._supports_cache = None
+        # Past inputs of the dilated convolutions per layer for streaming inference, see prime and step
+        self._queues = None
+
+    def train(self, mode=True):
+        # A stack of the static supports alone stays valid, the trainer calls train() every batch
+        if self.addaptadj:
+            self._supports_cache = None
+        return super(gwnet, self).train(mode)
+
+    def _get_supports(self):
+        """
+        Supports of the gcn layers: the static ones plus the adaptive adjacency, as the stack_supports operator
+        for the stacked gcn strategy. Without the adaptive adjacency they never change, in inference (eval mode
+        without autograd) neither do the parameters. Then they are computed once and cached until the node
+        embeddings change in place (optimizer step, load_state_dict), move (to) or train() is called.
+        """
+        if not (self.gcn_bool and self.supports is not None):
+            return self.supports
+        adaptive = self.addaptadj
+        if not adaptive and self.gcn_strategy == 'chain':
+            return self.supports
+        cache = not adaptive or (not self.training and not torch.is_grad_enabled())
+        if cache:
+            params = (self.nodevec1, self.nodevec2) if adaptive else ()
+            key = (id(self.supports), self.adaptive_topk, self.gcn_strategy,
+                   tuple((p.data_ptr(), p._version) for p in params))
+            if self._supports_cache is not None and self._supports_cache[0] == key:
+                return self._supports_cache[1]
+
+        new_supports = self.supports
+        if adaptive:
+            # calculate the current adaptive adj matrix once per iteration
+            if self.adaptive_topk:
+                adp = topk_adaptive_adj(self.nodevec1, self.nodevec2, self.adaptive_topk)
+            else:
+                adp = F.softmax(F.relu(torch.mm(self.nodevec1, self.nodevec2)), dim=1)
+            new_supports = self.supports + [adp]
+        if self.gcn_strategy == 'stacked':
+            new_supports = stack_supports(new_supports, self.gconv[0].order)
+        if cache:
+            self._supports_cache = (key, new_supports)
+        return new_supports
 
 
 
     def forward(self, input):
+        return self._forward(input)
+
+    def _forward(self, input, queues=None):
+        """
+        :param queues: list filled with the input of every WaveNet layer over the last (kernel_size - 1) * dilation
+               steps, the past the dilated convolutions of the next frame need, see prime
+        """
         in_len = input.size(3)
         if in_len<self.receptive_field:
             x = nn.functional.pad(input,(self.receptive_field-in_len,0,0,0))
@@ -147,11 +286,7 @@ class gwnet(nn.Module):
         x = self.start_conv(x)
         skip = 0
 
-        # calculate the current adaptive adj matrix once per iteration
-        new_supports = None
-        if self.gcn_bool and self.addaptadj and self.supports is not None:
-            adp = F.softmax(F.relu(torch.mm(self.nodevec1, self.nodevec2)), dim=1)
-            new_supports = self.supports + [adp]
+        new_supports = self._get_supports()
 
         # WaveNet layers
         for i in range(self.blocks * self.layers):
@@ -169,43 +304,95 @@ class gwnet(nn.Module):
 
             #residual = dilation_func(x, dilation, init_dilation, i)
             residual = x
+            if queues is not None:
+                queues.append(residual[:, :, :, -self._queue_length(i):])
             # dilated convolution
             filter = self.filter_convs[i](residual)
             filter = torch.tanh(filter)
             gate = self.gate_convs[i](residual)
             gate = torch.sigmoid(gate)
             x = filter * gate
+            x, skip = self._layer_output(i, x, residual, skip, new_supports)
 
-            # parametrized skip connection
+        x = F.relu(skip)
+        x = F.relu(self.end_conv_1(x))
+        x = self.end_conv_2(x)
+        return x
 
-            s = x
-            s = self.skip_convs[i](s)
-            try:
-                skip = skip[:, :, :,  -s.size(3):]
-            except:
-                skip = 0
-            skip = s + skip
+    def _layer_output(self, i, x, residual, skip, new_supports):
+        """
+        Layer i after the gated dilated convolution x.
+        :return: (input of the next layer, skip)
+        """
+        # parametrized skip connection
 
+        s = x
+        s = self.skip_convs[i](s)
+        try:
+            skip = skip[:, :, :,  -s.size(3):]
+        except:
+            skip = 0
+        skip = s + skip
 
-            if self.gcn_bool and self.supports is not None:
-                if self.addaptadj:
-                    x = self.gconv[i](x, new_supports)
-                else:
-                    x = self.gconv[i](x,self.supports)
-            else:
-                x = self.residual_convs[i](x)
 
-            x = x + residual[:, :, :, -x.size(3):]
+        if self.gcn_bool and self.supports is not None:
+            x = self.gconv[i](x, new_supports)
+        else:
+            x = self.residual_convs[i](x)
+
+        x = x + residual[:, :, :, -x.size(3):]
+
+
+        x = self.bn[i](x)
+        return x, skip
+
+    def _queue_length(self, i):
+        conv = self.filter_convs[i]
+        return (conv.kernel_size[1] - 1) * conv.dilation[1]
+
+    def prime(self, input):
+        """
+        Starts streaming inference in the style of Fast WaveNet generation: the window runs through the batch
+        forward once, keeping per layer the queue of past inputs its dilated convolutions will read.
+        Inference only, the model must be in eval mode.
+        :param input: (batch_size, in_dim, num_nodes, seq_len) window, zero padded to the receptive field as
+               in forward
+        :return: forward(input)
+        """
+        assert not self.training, 'Streaming inference requires eval mode'
+        queues = []
+        output = self._forward(input, queues)
+        self._queues = queues
+        return output
+
+    def step(self, frame):
+        """
+        Advances the stream primed by prime by one frame. Each layer computes a single column, its dilated
+        convolutions read the column of the new frame and the queued columns (kernel_size - 1) * dilation
+        steps back, all the other operations act on each step independently.
+        :param frame: (batch_size, in_dim, num_nodes, 1) newest frame
+        :return: (batch_size, out_dim, num_nodes, 1), forward of the last receptive_field frames of the stream
+        """
+        assert not self.training, 'Streaming inference requires eval mode'
+        assert self._queues is not None, 'Call prime before step'
+        x = self.start_conv(frame)
+        skip = 0
 
+        new_supports = self._get_supports()
 
-            x = self.bn[i](x)
+        for i in range(self.blocks * self.layers):
+            residual = x
+            queue = self._queues[i]
+            dilation = self.filter_convs[i].dilation[1]
+            # The taps of the dilated convolutions, with dilation 1 on the gathered columns
+            taps = torch.cat([queue[:, :, :, ::dilation], residual], dim=3)
+            self._queues[i] = torch.cat([queue[:, :, :, 1:], residual], dim=3)
+            filter = torch.tanh(F.conv2d(taps, self.filter_convs[i].weight, self.filter_convs[i].bias))
+            gate = torch.sigmoid(F.conv2d(taps, self.gate_convs[i].weight, self.gate_convs[i].bias))
+            x = filter * gate
+            x, skip = self._layer_output(i, x, residual, skip, new_supports)
 
         x = F.relu(skip)
         x = F.relu(self.end_conv_1(x))
         x = self.end_conv_2(x)
         return x
-
-
-
-
-
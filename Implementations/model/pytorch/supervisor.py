@@ -3,9 +3,10 @@ import numpy as np
 import argparse
 import time
 from lib import utils
+from lib.dataloaders.prefetcher import Prefetcher
 from lib.metrics import metrics_torch, metrics_np
 from model.pytorch.engine import Trainer, Evaluator
-from model.pytorch.gwnet_model import gwnet
+from model.pytorch.gwnet_model import check_gcn_options, gwnet
 from model.pytorch.lstm_model import LSTMNet
 
 
@@ -19,12 +20,16 @@ def get_argument_parser():
     parser.add_argument('--aptonly', action='store_true', help='whether only adaptive adj')
     parser.add_argument('--addaptadj', action='store_true', help='whether add adaptive adj')
     parser.add_argument('--randomadj', action='store_true', help='whether random initialize adaptive adj')
+    parser.add_argument('--sparse_supports', action='store_true', help='diffuse with sparse (CSR) supports, for large graphs')
+    parser.add_argument('--adaptive_topk', type=int, default=None, help='neighbours per node kept in the adaptive adj, dense if not given')
+    parser.add_argument('--gcn_strategy', type=str, default='chain', choices=['chain', 'stacked'], help='stacked diffuses with one precomputed [I, A, A^2] operator')
     parser.add_argument('--seq_length', type=int, default=12, help='')
     parser.add_argument('--nhid', type=int, default=32, help='')
     parser.add_argument('--in_dim', type=int, default=2, help='inputs dimension')
     parser.add_argument('--batch_size', type=int, default=64, help='batch size')
     parser.add_argument('--dropout', type=float, default=0.3, help='dropout rate')
     parser.add_argument('--seed', type=int, default=42, help='random seed')
+    parser.add_argument('--prefetch', type=int, default=0, help='number of batches prepared in a background thread, 0 disables it')
     # model selection
     parser.add_argument('--checkpoint', type=str, help='load a model')
     parser.add_argument('--isolated_sensors', action='store_true', help='separate model for each sensor')
@@ -33,6 +38,16 @@ def get_argument_parser():
     return parser
 
 
+def parse_args(parser):
+    """parser.parse_args, rejecting gwnet options that do not combine."""
+    args = parser.parse_args()
+    try:
+        check_gcn_options(args.gcn_strategy, args.sparse_supports, args.adaptive_topk)
+    except ValueError as e:
+        parser.error(str(e))
+    return args
+
+
 class Supervisor:
 
     def __init__(self, adj_mx, args):
@@ -50,13 +65,24 @@ class Supervisor:
         y = y[:, 0, :, :]
         return x, y
 
+    @staticmethod
+    def _prepare_host_data(x, y):
+        x = torch.Tensor(x).transpose(1, 3).contiguous()
+        y = torch.Tensor(y).transpose(1, 3)[:, 0, :, :].contiguous()
+        return x, y
+
+    def _get_batches(self, loader):
+        iterator = loader.get_iterator()
+        if getattr(self.args, 'prefetch', 0) > 0:
+            return Prefetcher(iterator, self._prepare_host_data, self.args.prefetch, device=self.device)
+        return (self._prepare_data(x, y) for x, y in iterator)
 
     def run_epoch(self, loader, engine_fn, print_every=-1):
         ep_loss = []
         ep_rmse = []
         ep_mape = []
-        for iter, (x, y) in enumerate(loader.get_iterator()):
-            x, y = self._prepare_data(x, y)
+        batches = self._get_batches(loader)
+        for iter, (x, y) in enumerate(batches):
             mae, rmse, mape = engine_fn(x, y)
             ep_loss.append(mae)
             ep_rmse.append(rmse)
@@ -65,6 +91,8 @@ class Supervisor:
                 log = 'Iter: {:03d}, Train Loss: {:.4f}, Train RMSE: {:.4f}, Train MAPE: {:.4f}'
                 print(log.format(iter, ep_loss[-1], ep_rmse[-1], ep_mape[-1]), flush=True)
             # if iter > 50: return
+        if isinstance(batches, Prefetcher):
+            print('Prefetching saved {:.1f}s, waited {:.1f}s for data'.format(batches.saved_time, batches.wait_time))
         return ep_loss, ep_rmse, ep_mape
 
 
@@ -97,7 +125,9 @@ class Supervisor:
             model = gwnet(self.device, num_nodes, args.dropout, supports=supports, gcn_bool=args.gcn_bool,
                           addaptadj=args.addaptadj, aptinit=adjinit, in_dim=args.in_dim, out_dim=args.seq_length,
                           residual_channels=args.nhid,
-                          dilation_channels=args.nhid, skip_channels=args.nhid * 8, end_channels=args.nhid * 16)
+                          dilation_channels=args.nhid, skip_channels=args.nhid * 8, end_channels=args.nhid * 16,
+                          sparse_supports=args.sparse_supports, adaptive_topk=args.adaptive_topk,
+                          gcn_strategy=args.gcn_strategy)
             model.to(self.device)
             if args.checkpoint:
                 model.load_state_dict(torch.load(args.checkpoint))
@@ -107,7 +137,7 @@ class Supervisor:
 
     def show_multiple_horizon(self, scaler, loader):
         args = self.args
-        engine = Evaluator(scaler, self.device, self.model)
+        engine = Evaluator(scaler, self.device, self.model, num_prefetch=args.prefetch)
 
         yhat, realy = engine.compute_preds(loader)
         amae = []
@@ -0,0 +1,177 @@
+import logging
+import os
+import tempfile
+import unittest
+
+import torch
+
+from lib.testing import random_supports
+from model.pytorch.dcrnn_cell import DCGRUCell
+from model.pytorch.dcrnn_export import export
+from model.pytorch.dcrnn_model import DCRNNModel
+
+
+def reference_gconv(cell, inputs, state, output_size, bias_start=0.0):
+    """DCGRUCell._gconv before the diffusion stack was fused, one torch.cat per diffusion order."""
+    batch_size = inputs.shape[0]
+    inputs = torch.reshape(inputs, (batch_size, cell._num_nodes, -1))
+    state = torch.reshape(state, (batch_size, cell._num_nodes, -1))
+    inputs_and_state = torch.cat([inputs, state], dim=2)
+    input_size = inputs_and_state.size(2)
+
+    x0 = inputs_and_state.permute(1, 2, 0)
+    x0 = torch.reshape(x0, shape=[cell._num_nodes, input_size * batch_size])
+    x = torch.unsqueeze(x0, 0)
+    if cell._max_diffusion_step > 0:
+        for support in cell._supports:
+            x1 = torch.sparse.mm(support, x0)
+            x = torch.cat([x, x1.unsqueeze(0)], dim=0)
+            for k in range(2, cell._max_diffusion_step + 1):
+                x2 = 2 * torch.sparse.mm(support, x1) - x0
+                x = torch.cat([x, x2.unsqueeze(0)], dim=0)
+                x1, x0 = x2, x1
+
+    num_matrices = len(cell._supports) * cell._max_diffusion_step + 1
+    x = torch.reshape(x, shape=[num_matrices, cell._num_nodes, input_size, batch_size])
+    x = x.permute(3, 1, 2, 0)
+    x = torch.reshape(x, shape=[batch_size * cell._num_nodes, input_size * num_matrices])
+    weights = cell._gconv_params.get_weights((input_size * num_matrices, output_size))
+    x = torch.matmul(x, weights)
+    x += cell._gconv_params.get_biases(output_size, bias_start)
+    return torch.reshape(x, [batch_size, cell._num_nodes * output_size])
+
+
+class DCGRUCellTestCase(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        self.supports = random_supports()
+        self.inputs = torch.randn(4, 20 * 2)
+        self.state = torch.randn(4, 20 * 8)
+
+    def test_gconv_equals_reference(self):
+        for max_diffusion_step in [0, 1, 2, 3]:
+            cell = DCGRUCell(8, self.supports, max_diffusion_step, 20)
+            expected = reference_gconv(cell, self.inputs, self.state, 16)
+            with torch.no_grad():
+                # The workspace is reused by the second call
+                for _ in range(2):
+                    torch.testing.assert_close(expected, cell._gconv(self.inputs, self.state, 16))
+            state = self.state.clone().requires_grad_()
+            actual = cell._gconv(self.inputs, state, 16)
+            torch.testing.assert_close(expected, actual)
+            actual.sum().backward()
+            self.assertIsNotNone(state.grad)
+
+    def test_sparse_formats(self):
+        supports = self.supports + self.supports[:1]
+        for max_diffusion_step in [1, 2, 3]:
+            cell = DCGRUCell(8, supports, max_diffusion_step, 20)
+            expected = reference_gconv(cell, self.inputs, self.state, 16)
+            for sparse_format in ['coo', 'csr']:
+                for stack_supports in [False, True]:
+                    other = DCGRUCell(8, supports, max_diffusion_step, 20, sparse_format=sparse_format,
+                                      stack_supports=stack_supports)
+                    other._gconv_params = cell._gconv_params
+                    with torch.no_grad():
+                        torch.testing.assert_close(expected, other._gconv(self.inputs, self.state, 16))
+                    state = self.state.clone().requires_grad_()
+                    torch.testing.assert_close(expected, other._gconv(self.inputs, state, 16))
+
+    def test_reuse_input_diffusion(self):
+        cell = DCGRUCell(8, self.supports, 2, 20)
+        reuse_cell = DCGRUCell(8, self.supports, 2, 20, reuse_input_diffusion=True)
+        expected = cell(self.inputs, self.state)
+        reuse_cell._gconv_params = cell._gconv_params
+        torch.testing.assert_close(expected, reuse_cell(self.inputs, self.state))
+        # All timesteps projected at once
+        inputs = torch.stack([self.inputs, 2 * self.inputs])
+        gates, candidate = reuse_cell.project_inputs(inputs)
+        torch.testing.assert_close(cell(inputs[1], self.state), reuse_cell(inputs[1], self.state, (gates[1], candidate[1])))
+
+    def test_encoder_precomputed_inputs(self):
+        model_kwargs = dict(num_nodes=20, rnn_units=8, seq_len=3, horizon=2, input_dim=2, max_diffusion_step=2,
+                            num_rnn_layers=2)
+        model = DCRNNModel(self.supports, logging.getLogger(), **model_kwargs)
+        fast_model = DCRNNModel(self.supports, logging.getLogger(), reuse_input_diffusion=True, **model_kwargs)
+        inputs = torch.randn(3, 4, 20 * 2)
+        fast_model.load_state_dict(model.state_dict())
+        torch.testing.assert_close(model.encoder(inputs), fast_model.encoder(inputs))
+
+    def test_eager_parameters(self):
+        for use_gc_for_ru in [True, False]:
+            lazy_cell = DCGRUCell(8, self.supports, 2, 20, use_gc_for_ru=use_gc_for_ru)
+            lazy_cell(self.inputs, self.state)
+            cell = DCGRUCell(8, self.supports, 2, 20, use_gc_for_ru=use_gc_for_ru, input_dim=2)
+            # Same names, order and shapes as the parameters registered by the first forward pass
+            self.assertEqual([(k, v.shape) for k, v in lazy_cell.state_dict().items()],
+                             [(k, v.shape) for k, v in cell.state_dict().items()])
+            cell.load_state_dict(lazy_cell.state_dict())
+            torch.testing.assert_close(lazy_cell(self.inputs, self.state), cell(self.inputs, self.state))
+
+    def test_export(self):
+        model_kwargs = dict(num_nodes=20, rnn_units=8, seq_len=3, horizon=2, input_dim=2, max_diffusion_step=2,
+                            num_rnn_layers=2)
+        model = DCRNNModel(self.supports, logging.getLogger(), **model_kwargs).eval()
+        inputs = torch.randn(3, 4, 20 * 2)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'dcrnn.pt')
+            export(model, path)
+            scripted = torch.jit.load(path)
+        with torch.no_grad():
+            torch.testing.assert_close(model(inputs), scripted(inputs))
+        # The weights are matched by shape, not by the order they were created in
+        for cell in model.encoder_model.dcgru_layers:
+            for params in [cell._gconv_params._params_dict, cell._gconv_params._biases_dict]:
+                items = list(params.items())
+                params.clear()
+                params.update(reversed(items))
+        with torch.no_grad():
+            torch.testing.assert_close(model(inputs), export(model)(inputs))
+
+    def test_curriculum(self):
+        model_kwargs = dict(num_nodes=20, rnn_units=8, seq_len=3, horizon=2, input_dim=2, max_diffusion_step=2,
+                            num_rnn_layers=2, use_curriculum_learning=True)
+        hidden_state = torch.randn(2, 4, 20 * 8)
+        labels = torch.randn(2, 4, 20)
+        for per_sample in [False, True]:
+            model = DCRNNModel(self.supports, logging.getLogger(), curriculum_per_sample=per_sample, **model_kwargs)
+            with torch.no_grad():
+                first, state = model.decoder_model(torch.zeros(4, 20), hidden_state)
+                free_running = torch.stack([first, model.decoder_model(first, state)[0]])
+                teacher_forced = torch.stack([first, model.decoder_model(labels[0], state)[0]])
+                model._compute_sampling_threshold = lambda batches_seen: 1.
+                torch.testing.assert_close(teacher_forced, model.decoder(hidden_state, labels, 0))
+                model._compute_sampling_threshold = lambda batches_seen: 0.
+                torch.testing.assert_close(free_running, model.decoder(hidden_state, labels, 0))
+                model._compute_sampling_threshold = lambda batches_seen: .5
+                torch.manual_seed(2)
+                outputs = model.decoder(hidden_state, labels, 0)
+                forced = torch.isclose(outputs, teacher_forced).all(dim=2)[1]
+                free = torch.isclose(outputs, free_running).all(dim=2)[1]
+                self.assertTrue((forced | free).all())
+                if per_sample:
+                    self.assertTrue(forced.any() and free.any())
+                else:
+                    self.assertTrue(forced.all() or free.all())
+
+    def test_autocast(self):
+        model_kwargs = dict(num_nodes=20, rnn_units=8, seq_len=3, horizon=2, input_dim=2, max_diffusion_step=2,
+                            num_rnn_layers=2)
+        model = DCRNNModel(self.supports, logging.getLogger(), **model_kwargs)
+        inputs = torch.randn(3, 4, 20 * 2)
+        expected = model(inputs)
+        for dtype in [torch.bfloat16, torch.float16]:
+            model.zero_grad()
+            with torch.autocast('cpu', dtype=dtype):
+                outputs = model(inputs)
+                # The diffusion stack stays in float32
+                self.assertEqual(torch.float32, model.encoder_model.dcgru_layers[0]._diffusion_stack(
+                    inputs[0].view(4, 20, 2).to(dtype)).dtype)
+            self.assertEqual(dtype, outputs.dtype)
+            torch.testing.assert_close(expected, outputs.float(), rtol=0.05, atol=0.05)
+            outputs.float().sum().backward()
+            self.assertTrue(all(p.grad is not None and p.grad.dtype == torch.float32 for p in model.parameters()))
+
+
+if __name__ == '__main__':
+    unittest.main()
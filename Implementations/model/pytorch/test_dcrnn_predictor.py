@@ -0,0 +1,71 @@
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import torch
+
+from lib.testing import random_supports, synthetic_readings
+from lib.dataloaders.dataloader import Dataset
+from model.pytorch.dcrnn_model import DCRNNModel
+from model.pytorch.dcrnn_predictor import DCRNNPredictor
+
+
+class DCRNNPredictorTestCase(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        self.tmpdir = tempfile.mkdtemp()
+        self.supports = random_supports()
+        self.model_kwargs = dict(num_nodes=20, rnn_units=8, seq_len=3, horizon=2, input_dim=2, output_dim=1,
+                                 max_diffusion_step=2, num_rnn_layers=2)
+        self.model = DCRNNModel(self.supports, logging.getLogger(), **self.model_kwargs).eval()
+        dataset_file = os.path.join(self.tmpdir, 'test.h5')
+        np.savez(dataset_file + '.scaler.npz', mean=50., std=10.)
+        self.checkpoint_file = os.path.join(self.tmpdir, 'dcrnn.tar')
+        torch.save({'data': {'dataset_file': dataset_file}, 'model': self.model_kwargs,
+                    'model_state_dict': self.model.state_dict(), 'epoch': 1}, self.checkpoint_file)
+        self.df = synthetic_readings(3, 20, start='2012-03-01 07:00')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_predict(self):
+        x = Dataset.enrich(self.df)
+        x[..., 0] = (x[..., 0] - 50.) / 10.
+        with torch.no_grad():
+            expected = self.model(torch.from_numpy(x).float().reshape(3, 1, -1)).view(2, 20, 1).numpy() * 10. + 50.
+        for script in [False, True]:
+            predictor = DCRNNPredictor(self.supports, self.checkpoint_file, script=script)
+            forecast = predictor.predict(self.df.values, self.df.index.values)
+            np.testing.assert_allclose(expected, forecast, rtol=1e-5, atol=1e-4)
+            windows = np.stack([self.df.values, self.df.values[::-1]])
+            forecasts = predictor.predict(windows, np.stack([self.df.index.values] * 2))
+            np.testing.assert_allclose(forecast, forecasts[0], rtol=1e-5, atol=1e-4)
+
+    def test_step(self):
+        df = synthetic_readings(6, 20, start='2012-03-01 07:00', seed=1)
+        index = df.index
+        for script in [False, True]:
+            resynced = DCRNNPredictor(self.supports, self.checkpoint_file, script=script, resync_every=1)
+            streaming = DCRNNPredictor(self.supports, self.checkpoint_file, script=script)
+            for t in range(len(df)):
+                forecast = resynced.step(df.values[t], index.values[t])
+                streamed = streaming.step(df.values[t], index.values[t])
+                if t < 2:
+                    self.assertIsNone(forecast)
+                    continue
+                expected = streaming.predict(df.values[t - 2: t + 1], index.values[t - 2: t + 1])
+                np.testing.assert_allclose(expected, forecast, rtol=1e-5, atol=1e-4)
+                if t == 2:
+                    np.testing.assert_allclose(expected, streamed, rtol=1e-5, atol=1e-4)
+            # Without resync the state holds all frames since the stream started
+            x = streaming._enrich(df.values, index.values)
+            with torch.no_grad():
+                expected = self.model.decoder(self.model.encoder(torch.from_numpy(x).reshape(6, 1, -1)))
+            np.testing.assert_allclose(streaming._descale(expected, 1)[0], streamed, rtol=1e-5, atol=1e-4)
+
+
+if __name__ == '__main__':
+    unittest.main()
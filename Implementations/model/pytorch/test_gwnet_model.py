@@ -0,0 +1,96 @@
+import unittest
+
+import torch
+
+from lib.testing import random_supports
+from model.pytorch.gwnet_model import gwnet
+
+
+class GwnetTestCase(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        self.supports = [torch.tensor(a) for a in random_supports(adjtype='doubletransition')]
+        self.inputs = torch.randn(4, 2, 20, 13)
+
+    def test_sparse_supports(self):
+        model = gwnet('cpu', 20, supports=self.supports, aptinit=self.supports[0])
+        sparse_model = gwnet('cpu', 20, supports=self.supports, aptinit=self.supports[0], sparse_supports=True)
+        sparse_model.load_state_dict(model.state_dict())
+        model.eval()
+        sparse_model.eval()
+        torch.testing.assert_close(model(self.inputs), sparse_model(self.inputs))
+        inputs = self.inputs.clone().requires_grad_()
+        sparse_model(inputs).sum().backward()
+        self.assertIsNotNone(inputs.grad)
+        self.assertIsNotNone(sparse_model.nodevec1.grad)
+
+    def test_adaptive_topk(self):
+        model = gwnet('cpu', 20, supports=self.supports, aptinit=self.supports[0])
+        # All neighbours kept is the dense adaptive adjacency
+        topk_model = gwnet('cpu', 20, supports=self.supports, aptinit=self.supports[0], adaptive_topk=20)
+        topk_model.load_state_dict(model.state_dict())
+        model.eval()
+        topk_model.eval()
+        torch.testing.assert_close(model(self.inputs), topk_model(self.inputs), rtol=1e-4, atol=1e-4)
+        topk_model.adaptive_topk = 3
+        topk_model(self.inputs).pow(2).sum().backward()
+        self.assertTrue(topk_model.nodevec1.grad.abs().sum() > 0)
+
+    def test_supports_cache(self):
+        model = gwnet('cpu', 20, supports=self.supports, aptinit=self.supports[0]).eval()
+        with torch.no_grad():
+            supports = model._get_supports()
+            self.assertIs(supports, model._get_supports())
+            expected = model(self.inputs)
+            # In-place updates of the node embeddings invalidate the cache
+            model.nodevec1.mul_(2)
+            self.assertIsNot(supports, model._get_supports())
+            self.assertFalse(torch.equal(expected, model(self.inputs)))
+            model.nodevec1.div_(2)
+            torch.testing.assert_close(expected, model(self.inputs))
+            supports = model._get_supports()
+            model.train()
+            self.assertIsNone(model._supports_cache)
+            model.eval()
+            self.assertIsNot(supports, model._get_supports())
+        # Not cached when a gradient is recorded
+        self.assertIsNot(model._get_supports(), model._get_supports())
+
+    def test_stacked_gcn(self):
+        for addaptadj in [True, False]:
+            model = gwnet('cpu', 20, supports=self.supports, aptinit=self.supports[0], addaptadj=addaptadj)
+            stacked_model = gwnet('cpu', 20, supports=self.supports, aptinit=self.supports[0], addaptadj=addaptadj,
+                                  gcn_strategy='stacked')
+            stacked_model.load_state_dict(model.state_dict())
+            model.eval()
+            stacked_model.eval()
+            torch.testing.assert_close(model(self.inputs), stacked_model(self.inputs), rtol=1e-4, atol=1e-4)
+            stacked_model(self.inputs).pow(2).sum().backward()
+            if addaptadj:
+                self.assertTrue(stacked_model.nodevec1.grad.abs().sum() > 0)
+            else:
+                # The operator of the static supports is kept across train()
+                operator = stacked_model._get_supports()
+                stacked_model.train()
+                self.assertIs(operator, stacked_model._get_supports())
+        # The stacked operator would densify sparse supports
+        for kwargs in [{'sparse_supports': True}, {'adaptive_topk': 3}]:
+            with self.assertRaises(ValueError):
+                gwnet('cpu', 20, supports=self.supports, aptinit=self.supports[0], gcn_strategy='stacked', **kwargs)
+
+    def test_streaming(self):
+        model = gwnet('cpu', 20, supports=self.supports, aptinit=self.supports[0]).eval()
+        stream = torch.randn(2, 2, 20, 20)
+        with torch.no_grad():
+            torch.testing.assert_close(model.prime(stream[..., :13]), model(stream[..., :13]))
+            for t in range(13, 20):
+                # The batch forward on the window of the last receptive_field frames
+                torch.testing.assert_close(model.step(stream[..., t:t + 1]), model(stream[..., t - 12:t + 1]),
+                                           rtol=1e-5, atol=1e-5)
+        model.train()
+        with self.assertRaises(AssertionError):
+            model.step(stream[..., :1])
+
+
+if __name__ == '__main__':
+    unittest.main()
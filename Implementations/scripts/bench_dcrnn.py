@@ -0,0 +1,123 @@
+import argparse
+import logging
+import time
+
+import numpy as np
+import torch
+import yaml
+
+from lib import utils
+from model.pytorch.dcrnn_cell import DCGRUCell
+from model.pytorch.dcrnn_export import export
+from model.pytorch.dcrnn_model import DCRNNModel
+from model.pytorch.test_dcrnn_cell import reference_gconv
+
+
+def load_supports(args, num_nodes):
+    # METR-LA and PEMS-BAY are benchmarked on their real graphs
+    graph_pkl_filename = {207: args.graph_pkl_filename, 325: args.bay_graph_pkl_filename}.get(num_nodes)
+    if graph_pkl_filename:
+        _, _, supports = utils.load_adj(graph_pkl_filename, 'dual_random_walk')
+        return supports
+    adj_mx = utils.random_graph(num_nodes)
+    return [np.transpose(utils.calculate_random_walk_matrix(adj_mx)),
+            np.transpose(utils.calculate_random_walk_matrix(np.transpose(adj_mx)))]
+
+
+def timeit(fn, repeats, warmup=3):
+    for _ in range(warmup):
+        fn()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fn()
+    return (time.perf_counter() - start) / repeats * 1000
+
+
+def bench_gconv(args):
+    print('nodes\tbatch\tgrad\treference ms\tfused ms\tmax abs diff')
+    for num_nodes in args.num_nodes:
+        supports = load_supports(args, num_nodes)
+        cell = DCGRUCell(args.rnn_units, supports, args.max_diffusion_step, num_nodes)
+        inputs = torch.randn(args.batch_size, num_nodes * args.input_dim)
+        state = torch.randn(args.batch_size, num_nodes * args.rnn_units)
+        output_size = 2 * args.rnn_units
+        for grad in [False, True]:
+            hx = state.clone().requires_grad_(grad)
+            with torch.set_grad_enabled(grad):
+                expected = reference_gconv(cell, inputs, hx, output_size)
+                actual = cell._gconv(inputs, hx, output_size)
+                diff = (expected - actual).abs().max().item()
+                reference_ms = timeit(lambda: reference_gconv(cell, inputs, hx, output_size), args.repeats)
+                fused_ms = timeit(lambda: cell._gconv(inputs, hx, output_size), args.repeats)
+            print('%d\t%d\t%s\t%.2f\t\t%.2f\t\t%.2e' % (num_nodes, args.batch_size, grad, reference_ms, fused_ms, diff))
+
+
+def bench_supports(args):
+    variants = [('coo', False), ('csr', False), ('coo', True), ('csr', True)]
+    print('diffusion stack\nnodes\tbatch\tgrad\t' + '\t'.join('%s%s ms' % (f, '+stacked' if s else '') for f, s in variants))
+    for num_nodes in args.num_nodes:
+        supports = load_supports(args, num_nodes)
+        cells = [DCGRUCell(args.rnn_units, supports, args.max_diffusion_step, num_nodes,
+                           sparse_format=sparse_format, stack_supports=stack_supports)
+                 for sparse_format, stack_supports in variants]
+        inputs = torch.randn(args.batch_size, num_nodes, args.input_dim)
+        state = torch.randn(args.batch_size, num_nodes, args.rnn_units)
+        for grad in [False, True]:
+            hx = state.clone().requires_grad_(grad)
+            times = []
+            # Only the diffusion depends on the format of the supports
+            with torch.set_grad_enabled(grad):
+                expected = cells[0]._diffusion_stack(inputs, hx).clone()
+                for cell in cells:
+                    torch.testing.assert_close(expected, cell._diffusion_stack(inputs, hx), rtol=1e-4, atol=1e-4)
+                    times.append(timeit(lambda: cell._diffusion_stack(inputs, hx), args.repeats))
+                del expected
+            print('%d\t%d\t%s\t' % (num_nodes, args.batch_size, grad) + '\t'.join('%.2f' % t for t in times))
+
+
+def bench_export(args):
+    with open(args.config_filename) as f:
+        model_kwargs = yaml.safe_load(f)['model']
+    supports = load_supports(args, int(model_kwargs['num_nodes']))
+    model = DCRNNModel(supports, logging.getLogger(), **model_kwargs).eval()
+    scripted = export(model)
+    print('nodes\tbatch\teager ms\tscripted ms\tmax abs diff')
+    for batch_size in args.batch_sizes:
+        inputs = torch.randn(int(model_kwargs['seq_len']), batch_size,
+                             model.num_nodes * int(model_kwargs['input_dim']))
+        with torch.no_grad():
+            diff = (model(inputs) - scripted(inputs)).abs().max().item()
+            eager_ms = timeit(lambda: model(inputs), args.repeats)
+            scripted_ms = timeit(lambda: scripted(inputs), args.repeats)
+        print('%d\t%d\t%.2f\t\t%.2f\t\t%.2e' % (model.num_nodes, batch_size, eager_ms, scripted_ms, diff))
+
+
+if __name__ == '__main__':
+    # Ex with python -m scripts.bench_dcrnn --bench supports --num_nodes 207 325 5000
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--bench', default='gconv', choices=['gconv', 'supports', 'export'],
+                        help='gconv: fused against the previous _gconv, supports: sparse formats and stacking, '
+                             'export: TorchScript inference model against the eager DCRNNModel.')
+    parser.add_argument('--config_filename', default='data/metr-la/pretrained/dcrnn_config.yaml', type=str,
+                        help='Model of the export benchmark.')
+    parser.add_argument('--graph_pkl_filename', default='data/sensor_graph/adj_mx.pkl', type=str,
+                        help='Graph of the 207 node benchmark, sizes other than 207 and 325 use synthetic graphs.')
+    parser.add_argument('--bay_graph_pkl_filename', default='data/sensor_graph/adj_mx_bay.pkl', type=str,
+                        help='Graph of the 325 node benchmark.')
+    parser.add_argument('--num_nodes', default=[207], type=int, nargs='+')
+    parser.add_argument('--batch_size', default=64, type=int)
+    parser.add_argument('--batch_sizes', default=[1, 8, 64], type=int, nargs='+', help='of the export benchmark')
+    parser.add_argument('--input_dim', default=2, type=int)
+    parser.add_argument('--rnn_units', default=64, type=int)
+    parser.add_argument('--max_diffusion_step', default=2, type=int)
+    parser.add_argument('--repeats', default=20, type=int)
+    parser.add_argument('--threads', default=None, type=int, help='torch threads, defaults to the torch default')
+    args = parser.parse_args()
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    if args.bench == 'gconv':
+        bench_gconv(args)
+    elif args.bench == 'supports':
+        bench_supports(args)
+    else:
+        bench_export(args)
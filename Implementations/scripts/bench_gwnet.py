@@ -0,0 +1,141 @@
+import argparse
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from lib import utils
+from model.pytorch.gwnet_model import gcn, gwnet, nconv, sparse_support, stack_supports, topk_adaptive_adj
+from scripts.bench_dcrnn import timeit
+
+
+def load_supports(args, num_nodes, degree):
+    if num_nodes == 207 and degree is None:
+        _, _, supports = utils.load_adj(args.graph_pkl_filename, 'doubletransition')
+        return [torch.tensor(a) for a in supports]
+    adj_mx = utils.random_graph(num_nodes, degree)
+    return [torch.tensor(utils.asym_adj(adj_mx)), torch.tensor(utils.asym_adj(np.transpose(adj_mx)))]
+
+
+def bench_nconv(args):
+    print('gcn layer, dense einsum against CSR SpMM')
+    print('nodes\tdegree\tdensity\tgrad\tdense ms\tsparse ms\tspeedup')
+    for num_nodes in args.num_nodes:
+        for degree in args.degrees:
+            supports = load_supports(args, num_nodes, degree)
+            sparse_supports = [sparse_support(a) for a in supports]
+            density = float(np.mean([(a != 0).float().mean() for a in supports]))
+            layer = gcn(args.channels, args.channels, dropout=0., support_len=len(supports))
+            x = torch.randn(args.batch_size, args.channels, num_nodes, args.seq_length)
+            for grad in [False, True]:
+                with torch.set_grad_enabled(grad):
+                    torch.testing.assert_close(layer(x, supports), layer(x, sparse_supports), rtol=1e-4, atol=1e-4)
+                    dense_ms = timeit(lambda: run(layer, x, supports, grad), args.repeats)
+                    sparse_ms = timeit(lambda: run(layer, x, sparse_supports, grad), args.repeats)
+                print('%d\t%s\t%.4f\t%s\t%.2f\t\t%.2f\t\t%.2fx' % (num_nodes, degree or 'metr-la', density, grad,
+                                                                  dense_ms, sparse_ms, dense_ms / sparse_ms))
+
+
+def bench_adaptive(args):
+    print('adaptive adjacency and one nconv, with backward')
+    print('nodes\ttopk\tms')
+    layer = nconv()
+    for num_nodes in args.num_nodes:
+        nodevec1 = torch.randn(num_nodes, 10, requires_grad=True)
+        nodevec2 = torch.randn(10, num_nodes, requires_grad=True)
+        x = torch.randn(args.batch_size, args.channels, num_nodes, args.seq_length)
+        for k in [None] + args.topk:
+            if k is None and num_nodes > args.max_dense_nodes:
+                continue
+
+            def step():
+                if k is None:
+                    adp = F.softmax(F.relu(torch.mm(nodevec1, nodevec2)), dim=1)
+                else:
+                    adp = topk_adaptive_adj(nodevec1, nodevec2, k)
+                layer(x, adp).sum().backward()
+            print('%d\t%s\t%.2f' % (num_nodes, k or 'dense', timeit(step, args.repeats, warmup=1)))
+
+
+def bench_gcn(args):
+    print('gcn layer, hop by hop chain against the stacked [I, A, A^2] operator')
+    print('nodes\tbatch\tgrad\tchain ms\tstacked ms\tstacked+build ms')
+    for num_nodes in args.num_nodes:
+        supports = load_supports(args, num_nodes, args.degrees[0])
+        # The adaptive adjacency is dense
+        supports.append(torch.softmax(torch.relu(torch.randn(num_nodes, 10) @ torch.randn(10, num_nodes)), dim=1))
+        chain = gcn(args.channels, args.channels, dropout=0., support_len=len(supports))
+        stacked = gcn(args.channels, args.channels, dropout=0., support_len=len(supports), strategy='stacked')
+        stacked.load_state_dict(chain.state_dict())
+        operator = stack_supports(supports)
+        for batch_size in args.batch_sizes:
+            x = torch.randn(batch_size, args.channels, num_nodes, args.seq_length)
+            for grad in [False, True]:
+                with torch.set_grad_enabled(grad):
+                    torch.testing.assert_close(chain(x, supports), stacked(x, operator), rtol=1e-4, atol=1e-4)
+                    chain_ms = timeit(lambda: run(chain, x, supports, grad), args.repeats)
+                    stacked_ms = timeit(lambda: run(stacked, x, operator, grad), args.repeats)
+                    # Training rebuilds the operator every batch, once for all layers of gwnet
+                    build_ms = timeit(lambda: stack_supports(supports), args.repeats)
+                print('%d\t%d\t%s\t%.2f\t\t%.2f\t\t%.2f' % (num_nodes, batch_size, grad, chain_ms, stacked_ms,
+                                                          stacked_ms + build_ms / args.layers))
+
+
+def bench_stream(args):
+    print('gwnet inference per new frame, batch forward over the receptive field against streaming step')
+    print('nodes\tbatch\tforward ms\tstep ms\tspeedup\tmax abs diff')
+    for num_nodes in args.num_nodes:
+        supports = load_supports(args, num_nodes, args.degrees[0])
+        model = gwnet('cpu', num_nodes, supports=supports, aptinit=supports[0], in_dim=2).eval()
+        for batch_size in args.batch_sizes:
+            stream = torch.randn(batch_size, 2, num_nodes, model.receptive_field + args.repeats + 4)
+            window = stream[..., :model.receptive_field]
+            with torch.no_grad():
+                model.prime(stream[..., :model.receptive_field - 1])
+                diff = (model.step(stream[..., model.receptive_field - 1:model.receptive_field])
+                        - model(window)).abs().max().item()
+                frames = iter(stream[..., model.receptive_field:].split(1, dim=3))
+                forward_ms = timeit(lambda: model(window), args.repeats)
+                step_ms = timeit(lambda: model.step(next(frames)), args.repeats)
+            print('%d\t%d\t%.2f\t\t%.2f\t%.2fx\t%.2e' % (num_nodes, batch_size, forward_ms, step_ms,
+                                                         forward_ms / step_ms, diff))
+
+
+def run(layer, x, supports, grad):
+    h = layer(x, supports)
+    if grad:
+        h.sum().backward()
+
+
+if __name__ == '__main__':
+    # Ex with python -m scripts.bench_gwnet --num_nodes 207 1000 5000 --degrees 8 64
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--bench', default='nconv', choices=['nconv', 'adaptive', 'gcn', 'stream'],
+                        help='nconv: dense against sparse supports, adaptive: dense against top-k adaptive adj, '
+                             'gcn: chain against stacked gcn strategy, stream: gwnet forward against streaming step.')
+    parser.add_argument('--graph_pkl_filename', default='data/sensor_graph/adj_mx.pkl', type=str,
+                        help='Graph of the 207 node benchmark without --degrees, the other sizes use synthetic graphs.')
+    parser.add_argument('--num_nodes', default=[207], type=int, nargs='+')
+    parser.add_argument('--degrees', default=[None], type=int, nargs='+',
+                        help='random neighbours per node of the synthetic graphs')
+    parser.add_argument('--batch_size', default=16, type=int)
+    parser.add_argument('--batch_sizes', default=[1, 16, 64], type=int, nargs='+', help='of the gcn and stream benchmarks')
+    parser.add_argument('--layers', default=8, type=int, help='gcn layers sharing the operator, of the gcn benchmark')
+    parser.add_argument('--channels', default=32, type=int)
+    parser.add_argument('--seq_length', default=13, type=int)
+    parser.add_argument('--topk', default=[8, 32], type=int, nargs='+', help='of the adaptive benchmark')
+    parser.add_argument('--max_dense_nodes', default=10000, type=int,
+                        help='larger graphs skip the dense adaptive adj of the adaptive benchmark')
+    parser.add_argument('--repeats', default=10, type=int)
+    parser.add_argument('--threads', default=None, type=int, help='torch threads, defaults to the torch default')
+    args = parser.parse_args()
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    if args.bench == 'nconv':
+        bench_nconv(args)
+    elif args.bench == 'adaptive':
+        bench_adaptive(args)
+    elif args.bench == 'gcn':
+        bench_gcn(args)
+    else:
+        bench_stream(args)
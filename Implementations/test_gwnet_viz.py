@@ -0,0 +1,53 @@
+import os
+import pickle
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import torch
+
+import gwnet_viz
+from lib import utils
+from lib.testing import write_synthetic_dataset
+from model.pytorch.gwnet_model import gwnet
+
+
+class ParallelSweepTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        num_nodes = 6
+        adj_mx = utils.random_graph(num_nodes, degree=2)
+        adjdata = os.path.join(self.tmpdir, 'adj_mx.pkl')
+        with open(adjdata, 'wb') as f:
+            pickle.dump((list(range(num_nodes)), {i: i for i in range(num_nodes)}, adj_mx), f)
+        data = write_synthetic_dataset(os.path.join(self.tmpdir, 'test.h5'), num_timesteps=600, num_nodes=num_nodes)
+
+        torch.manual_seed(0)
+        supports = [torch.tensor(a) for a in utils.load_adj(adjdata, 'doubletransition')[2]]
+        model = gwnet('cpu', num_nodes, supports=supports, gcn_bool=True, addaptadj=True, aptinit=supports[0])
+        checkpoint = os.path.join(self.tmpdir, 'gwnet.pth')
+        torch.save(model.state_dict(), checkpoint)
+        self.args = gwnet_viz.parser.parse_args([
+            '--device', 'cpu', '--data', data, '--adjdata', adjdata, '--checkpoint', checkpoint, '--gcn_bool',
+            '--addaptadj', '--num_nodes', str(num_nodes), '--batch_size', '8', '--workers', '2',
+            '--threads_per_worker', '1'])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_parallel_sweep(self):
+        device = torch.device('cpu')
+        _, loader = gwnet_viz.load_loader(self.args)
+        model = gwnet_viz.load_model(self.args, device)
+        # Five sensors over two workers, the shards are uneven
+        sensors = range(5)
+        expected = gwnet_viz.sweep(self.args, model, loader, sensors, device, progress=False)
+        pred_mx = gwnet_viz.parallel_sweep(self.args, sensors)
+        self.assertEqual(pred_mx.shape, expected.shape)
+        self.assertEqual(pred_mx.shape[0], len(sensors))
+        np.testing.assert_allclose(pred_mx, expected, rtol=1e-5, atol=1e-6)
+
+
+if __name__ == '__main__':
+    unittest.main()